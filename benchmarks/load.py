@@ -0,0 +1,216 @@
+''' Load-testing benchmark for the generated CRUD routes.
+
+For every combination of field count and row count it builds a throwaway working directory with a synthetic
+.proto, starts Cruddy in it, preloads storage.db, then drives the list, view, new and add routes from a pool
+of client threads. Throughput and p50/p95/p99 latency per route are printed and written out as JSON.
+
+Run from the repository root (needs protoc and Flask):
+
+    python benchmarks/load.py --fields 5,20 --rows 1000,100000 --concurrency 8 --requests 2000 --output results.json
+    python benchmarks/load.py --mode localhost ...     # over a real socket instead of Flask's test client
+'''
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+from itertools import count
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utilities import source_dir, static_dir, PROTO_FILE_SUFFIX
+
+ROUTES = ["list", "view", "new", "add"]
+PRELOAD_BATCH_SIZE = 10000
+
+
+def write_proto(name, field_count):
+    ''' Writes a synthetic message with an id and (field_count - 1) string fields. '''
+    lines = ["message %s {" % name, "  required int32 id = 1;", "  optional string name = 2;"]
+    for number in range(3, field_count + 1):
+        lines.append("  optional string field%d = %d;" % (number, number))
+    lines.append("}")
+    with open(os.path.join(source_dir, name + PROTO_FILE_SUFFIX), 'w') as proto_file:
+        proto_file.write("\n".join(lines) + "\n")
+
+
+def synthetic_entry(meta_object, id):
+    entry = dict((field["name"], "%s %d" % (field["name"], id)) for field in meta_object.fields)
+    entry["id"] = id
+    return entry
+
+
+def preload(storage, meta_object, rows):
+    ''' Fills the table through the bulk path, one transaction per batch. '''
+    storage.open()
+    report = storage.add_entries(meta_object, (synthetic_entry(meta_object, id) for id in xrange(1, rows + 1)), PRELOAD_BATCH_SIZE)
+    storage.close()
+    if report["rejected"]:
+        raise Exception("Preloading rejected %d rows: %s" % (report["rejected"], report["batches"][0]["errors"]))
+
+
+class InProcessClient:
+
+    def __init__(self, app):
+        ''' Drives the app through Flask's test client, one client per thread. '''
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, data=None):
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(path, method=method, data=data)
+        return response.status_code
+
+
+class LocalhostClient:
+
+    def __init__(self, app):
+        ''' Drives the app over a real socket, served by Werkzeug's threaded server on a spare port. '''
+        from werkzeug.serving import make_server
+        self.server = make_server("127.0.0.1", 0, app, threaded=True)
+        self.base_url = "http://127.0.0.1:%d" % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request(self, method, path, data=None):
+        body = urllib.urlencode(data) if data is not None else None
+        try:
+            return urllib2.urlopen(self.base_url + path, body).getcode()
+        except urllib2.HTTPError, e:
+            return e.code
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def drive(client, requests, concurrency, make_request):
+    ''' Fires the requests from a pool of threads and summarises the latencies. '''
+    def _timed(number):
+        method, path, data = make_request(number)
+        started = default_timer()
+        status = client.request(method, path, data)
+        return default_timer() - started, status
+
+    pool = ThreadPool(concurrency)
+    started = default_timer()
+    results = pool.map(_timed, xrange(requests))
+    elapsed = default_timer() - started
+    pool.close()
+    pool.join()
+
+    latencies = sorted(latency for latency, _ in results)
+    errors = len([status for _, status in results if status >= 400])
+    return {
+        "requests": requests,
+        "errors": errors,
+        "seconds": elapsed,
+        "throughput": requests / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def run_case(field_count, rows, args):
+    ''' Builds a fresh working directory for one schema size and row count, and benchmarks every route against it. '''
+    from server import create_app
+
+    name = "Bench%d" % field_count
+    working_dir = tempfile.mkdtemp(prefix="cruddy-bench-")
+    original_dir = os.getcwd()
+    os.chdir(working_dir)
+    try:
+        os.mkdir(source_dir)
+        os.mkdir(static_dir) # Keeps housekeeping from downloading Bootstrap.
+        write_proto(name, field_count)
+
+        app = create_app(args.page_cache_size)
+        cruddy = app.cruddy
+        meta_object = cruddy.get_objects()[0]
+        lower_name = meta_object.name.lower()
+
+        started = default_timer()
+        preload(cruddy.storage, meta_object, rows)
+        preload_seconds = default_timer() - started
+
+        client = LocalhostClient(app) if args.mode == "localhost" else InProcessClient(app)
+        new_ids = count(rows + 1)
+        new_ids_lock = threading.Lock()
+
+        def _add(number):
+            with new_ids_lock:
+                id = next(new_ids)
+            return "POST", "/%s/add/" % lower_name, synthetic_entry(meta_object, id)
+
+        request_makers = {
+            "list": lambda number: ("GET", "/%s/" % lower_name, None),
+            "view": lambda number: ("GET", "/%s/%d/" % (lower_name, random.randint(1, rows)), None),
+            "new": lambda number: ("GET", "/%s/new/" % lower_name, None),
+            "add": _add,
+        }
+
+        results = {}
+        for route in args.routes:
+            results[route] = drive(client, args.requests, args.concurrency, request_makers[route])
+            print "  %-5s %8.1f req/s  p50 %7.2fms  p95 %7.2fms  p99 %7.2fms  errors %d" % (
+                route, results[route]["throughput"], results[route]["p50_ms"], results[route]["p95_ms"], results[route]["p99_ms"], results[route]["errors"])
+
+        if args.mode == "localhost":
+            client.stop()
+        cruddy.storage.shutdown()
+        return {"fields": field_count, "rows": rows, "preload_seconds": preload_seconds, "routes": results}
+    finally:
+        os.chdir(original_dir)
+        shutil.rmtree(working_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the generated CRUD routes.")
+    parser.add_argument("--fields", default="5,20", help="comma-separated field counts for the synthetic protos")
+    parser.add_argument("--rows", default="1000,10000", help="comma-separated row counts to preload (up to 1000000)")
+    parser.add_argument("--routes", default=",".join(ROUTES), help="comma-separated routes to drive")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=8, help="client threads")
+    parser.add_argument("--mode", choices=["inprocess", "localhost"], default="inprocess")
+    parser.add_argument("--page-cache-size", type=int, default=0)
+    parser.add_argument("--output", default="bench_results.json", help="where to write the JSON results")
+    args = parser.parse_args()
+    args.routes = args.routes.split(",")
+
+    cases = []
+    for field_count in map(int, args.fields.split(",")):
+        for rows in map(int, args.rows.split(",")):
+            print "%d fields, %d rows (%s, concurrency %d):" % (field_count, rows, args.mode, args.concurrency)
+            cases.append(run_case(field_count, rows, args))
+
+    output = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "mode": args.mode,
+        "concurrency": args.concurrency,
+        "requests_per_route": args.requests,
+        "page_cache_size": args.page_cache_size,
+        "cases": cases,
+    }
+    with open(args.output, 'w') as output_file:
+        json.dump(output, output_file, indent=2, sort_keys=True)
+    print "Wrote %s" % args.output
+
+
+if __name__ == "__main__":
+    main()
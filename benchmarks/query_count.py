@@ -0,0 +1,119 @@
+''' Query-count check: list and view pages should run the same number of SQL statements however many entries they show.
+
+Builds a throwaway working directory with a Ticket that links to two Authors, preloads it, then requests each page
+at two sizes through Flask's test client, counting Metrics.record_query() calls. Linked records have to be loaded a
+batch per linking field for the counts to match; a query per entry makes the bigger page run more. Exits non-zero
+if any page's counts differ.
+
+Run from the repository root (needs protoc and Flask):
+
+    python benchmarks/query_count.py [small page] [big page]
+'''
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utilities import source_dir, static_dir, PROTO_FILE_SUFFIX
+
+ROWS = 200
+
+PROTOS = {
+    "Author": '''message Author {
+  required int32 id = 1;
+  optional string name = 2;
+}
+''',
+    "Ticket": '''import "cruddy_options.proto";
+
+message Ticket {
+  required int32 id = 1;
+  optional string title = 2;
+  optional string status = 3 [(cruddy.indexed) = true];
+  optional int32 author_id = 4 [(cruddy.references) = "Author"];
+  optional int32 reviewer_id = 5 [(cruddy.references) = "Author"];
+}
+''',
+}
+
+
+def write_protos():
+    for name, text in PROTOS.items():
+        with open(os.path.join(source_dir, name + PROTO_FILE_SUFFIX), 'w') as proto_file:
+            proto_file.write(text)
+
+
+def preload(storage, cruddy):
+    ''' Gives every ticket its own author and reviewer, so a page links to as many records as it shows. '''
+    author = cruddy.meta_objects.get_object("author")
+    ticket = cruddy.meta_objects.get_object("ticket")
+    storage.open()
+    storage.add_entries(author, ({"id": id, "name": "author %d" % id} for id in xrange(1, 2 * ROWS + 1)))
+    storage.add_entries(ticket, ({"id": id, "title": "ticket %d" % id, "status": "open", "author_id": 2 * id - 1,
+                                  "reviewer_id": 2 * id} for id in xrange(1, ROWS + 1)))
+    storage.close()
+
+
+def count_queries(app, path):
+    ''' Requests the path twice, returning the queries the second request ran. The first one warms things up, so one-off
+    work like counting the rows into the count cache doesn't make pages look different. '''
+    app.test_client().get(path)
+    metrics = app.cruddy.metrics
+    queries = []
+    record_query = metrics.record_query
+    def _counting(name, sql, seconds, rows):
+        queries.append(name)
+        record_query(name, sql, seconds, rows)
+    metrics.record_query = _counting
+    try:
+        status = app.test_client().get(path).status_code
+    finally:
+        metrics.record_query = record_query
+    if status != 200:
+        raise Exception("%s returned %d" % (path, status))
+    return queries
+
+
+def main(small=5, big=100):
+    from server import create_app
+
+    working_dir = tempfile.mkdtemp(prefix="cruddy-queries-")
+    original_dir = os.getcwd()
+    os.chdir(working_dir)
+    try:
+        os.mkdir(source_dir)
+        os.mkdir(static_dir) # Keeps housekeeping from downloading Bootstrap.
+        write_protos()
+
+        # No page cache, so every request goes to storage.
+        app = create_app(0)
+        preload(app.cruddy.storage, app.cruddy)
+
+        pages = [
+            ("list", "/ticket/?limit=%d" % small, "/ticket/?limit=%d" % big),
+            ("filtered list", "/ticket/?status=open&limit=%d" % small, "/ticket/?status=open&limit=%d" % big),
+            ("list json", "/ticket.json?limit=%d" % small, "/ticket.json?limit=%d" % big),
+            ("view", "/ticket/1/", "/ticket/%d/" % ROWS),
+        ]
+        failed = False
+        for page, small_path, big_path in pages:
+            small_queries = count_queries(app, small_path)
+            big_queries = count_queries(app, big_path)
+            same = len(small_queries) == len(big_queries)
+            failed = failed or not same
+            print "  %-14s %3d queries  %3d queries  %s" % (page, len(small_queries), len(big_queries), "ok" if same else "DIFFERENT")
+            if not same:
+                print "    %s: %s\n    %s: %s" % (small_path, ", ".join(small_queries), big_path, ", ".join(big_queries))
+
+        app.cruddy.storage.shutdown()
+    finally:
+        os.chdir(original_dir)
+        shutil.rmtree(working_dir, ignore_errors=True)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,60 @@
+''' Micro-benchmark: per-request SQL building and dict_factory rows versus the compiled Accessor.
+
+Run from the repository root:  python benchmarks/row_factory.py [rows] [fields] [repeat]
+'''
+import os
+import sys
+import sqlite3
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from storage import Accessor
+
+
+class BenchObject:
+    ''' Just enough of a MetaObject for storage to work with. '''
+
+    def __init__(self, field_count):
+        self.name = "Bench"
+        self.fields = [{"name": "id", "type": "int32"}] + [{"name": "field%d" % i, "type": "string"} for i in range(field_count - 1)]
+
+
+def dict_factory(cursor, row):
+    ''' The row conversion DBStorage used to do for every result. '''
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
+
+
+def build_sql(meta_object):
+    ''' The list query DBStorage used to rebuild on every request. '''
+    name = meta_object.name.lower()
+    return 'select %s from %s order by id desc limit ?' % (", ".join(map(lambda field: field["name"].lower(), meta_object.fields)), name)
+
+
+def main(rows=500, field_count=10, repeat=200):
+    meta_object = BenchObject(field_count)
+    accessor = Accessor(meta_object)
+
+    connection = sqlite3.connect(":memory:")
+    connection.execute("create table %s (%s)" % (accessor.table, ", ".join(accessor.columns)))
+    connection.executemany(accessor.add_sql, ([i] + ["value %d" % i] * (field_count - 1) for i in xrange(rows)))
+
+    def old_path():
+        cur = connection.execute(build_sql(meta_object), (rows,))
+        return [dict_factory(cur, result) for result in cur.fetchall()]
+
+    def new_path():
+        return accessor.rows(connection.execute(accessor.list_sql, (rows,)).fetchall())
+
+    old = min(timeit.repeat(old_path, number=1, repeat=repeat))
+    new = min(timeit.repeat(new_path, number=1, repeat=repeat))
+    print "%d rows x %d fields, best of %d" % (rows, field_count, repeat)
+    print "  dict_factory: %8.3f ms" % (old * 1000)
+    print "  accessor:     %8.3f ms" % (new * 1000)
+    print "  speedup:      %8.2fx" % (old / new)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -1,18 +1,27 @@
 from html import HTMLGenerator
 from storage import DBStorage
+from memorystorage import MemoryStorage
 from meta_objects import MetaObjects
 from flaskrer import Flaskrer
 from housekeeper import Housekeeper
+from metrics import Metrics
+from utilities import PAGE_CACHE_SIZE, SLOW_REQUEST_SECONDS, GROUP_COMMIT, BOOTSTRAP_URL, STORAGE_BACKEND
+
+# The storage backends STORAGE_BACKEND can name.
+storage_backends = {"sqlite": DBStorage, "memory": MemoryStorage}
 
 class Cruddy:
     
-    def __init__(self):
+    def __init__(self, page_cache_size=PAGE_CACHE_SIZE, interactive=True, slow_request_seconds=SLOW_REQUEST_SECONDS, group_commit=GROUP_COMMIT, bootstrap_source=BOOTSTRAP_URL,
+                 storage_backend=STORAGE_BACKEND):
         # At this point it's all object delegation.
+        self.metrics = Metrics(slow_request_seconds)
         self.meta_objects = MetaObjects(self)
-        self.storage = DBStorage(self)
+        self.storage = storage_backends[storage_backend](self, interactive, group_commit)
+        # Housekeeping comes before the templates, which link the static files it fingerprints.
+        self.housekeeper = Housekeeper(self, bootstrap_source)
         self.html = HTMLGenerator(self)
-        self.flaskrer = Flaskrer(self)
-        self.housekeeper = Housekeeper(self)
+        self.flaskrer = Flaskrer(self, page_cache_size)
 
 
     def start(self):
@@ -1,19 +1,67 @@
-from flask import Flask, render_template, request, redirect
-from utilities import HTML_FILE_SUFFIX
+import csv
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import urllib
+from StringIO import StringIO
+from timeit import default_timer
+from flask import Flask, render_template, request, redirect, abort, jsonify, Markup, Response, g, send_file, safe_join
+from jinja2 import FileSystemBytecodeCache
+from pagecache import PageCache
+from utilities import html_dir, static_dir, jinja_cache_dir, HTML_FILE_SUFFIX, DEFAULT_PAGE_SIZE, BULK_BATCH_SIZE, EXPORT_BATCH_SIZE, MAX_EXPORT_BATCH_SIZE, PAGE_CACHE_SIZE, SEARCH_MATCH_START, SEARCH_MATCH_END, MIN_COMPRESS_SIZE, FINGERPRINTED_MAX_AGE, UNFINGERPRINTED_MAX_AGE
 
 class Flaskrer:
 
-    def __init__(self, cruddy):
+    def __init__(self, cruddy, page_cache_size=PAGE_CACHE_SIZE):
         ''' Initializes the Flask controller, registers the routings and database connections. '''
         self.cruddy = cruddy
-        self.app = Flask(__name__)
+        # Templates are generated into the working directory, next to protos/, so load them from there. Static files get our own route.
+        self.app = Flask(__name__, template_folder=os.path.abspath(html_dir), static_folder=None)
+
+        # Keep compiled templates on disk, so a restart doesn't recompile the ones that haven't changed.
+        self.app.jinja_options = dict(self.app.jinja_options, bytecode_cache=FileSystemBytecodeCache(jinja_cache_dir))
         
-        # Create the HTML routings.
-        for generated_object in self.cruddy.get_objects():
-            self.build_routing(generated_object)
+        # Create the HTML routings. They're shared by every object; each object's own route functions are made on its first request.
+        self.routes = {}
+        self.build_routing()
+
+        self.register_static_files()
 
+        # Timing goes first, so it wraps everything else that happens to a request. Compression goes last, so it sees the finished page.
+        self.register_metrics()
         self.register_db_connections()
-        
+        self.register_compression()
+
+        # Rendered list and view pages, checked against their object's version and dropped when we write to it.
+        self.page_cache = None
+        if page_cache_size:
+            self.page_cache = PageCache(page_cache_size)
+            self.cruddy.storage.write_listeners.append(self.page_cache.invalidate)
+            self.cruddy.metrics.collectors.append(self.page_cache_metrics)
+
+
+    def render(self, template, **context):
+        ''' Renders a template, recording how long it took. '''
+        started = default_timer()
+        page = render_template(template, **context)
+        self.cruddy.metrics.templates.observe((template,), default_timer() - started)
+        return page
+
+
+    def cached(self, meta_object, key, render):
+        ''' Returns the cached page for the key, rendering (and caching) it with render() if we don't have it for the
+        object's current version. '''
+        if self.page_cache is None:
+            return render()
+        version = self.cruddy.storage.get_version(meta_object)
+        page = self.page_cache.get(key, version)
+        if page is None:
+            page = render()
+            self.page_cache.put(key, page, version)
+        return page
+
 
     def run(self):
         ''' Starts up the app! '''
@@ -24,24 +72,108 @@ class Flaskrer:
         ''' Generates a function that will return the listing for the specific object name '''
         def _function():
             name = meta_object.name.lower()
-            entries = self.cruddy.storage.get_entries(meta_object)
-            return render_template(name + "_list" + HTML_FILE_SUFFIX, title=name, entries=entries)
+            def _render():
+                before = request.args.get("before", type=int)
+                after = request.args.get("after", type=int)
+                limit = request.args.get("limit", DEFAULT_PAGE_SIZE, type=int)
+                filter_args = [(key, value) for key, value in request.args.iteritems(multi=True) if key not in ("before", "after", "limit")]
+                try:
+                    filters = self.cruddy.storage.parse_filters(meta_object, filter_args)
+                except ValueError, e:
+                    abort(400, str(e))
+                page = self.cruddy.storage.get_page(meta_object, before, after, limit, filters)
+                page["filter_query"] = "&" + urllib.urlencode([(key, value.encode("utf-8")) for key, value in filter_args]) if filter_args else ""
+                return self.render(name + "_list" + HTML_FILE_SUFFIX, title=name, entries=page["entries"], page=page, links=page["links"])
+            return self.cached(meta_object, (name, "list", request.query_string), _render)
+        return _function
+
+
+    def generate_list_json_routing(self, meta_object):
+        ''' Generates a function that will return a page of the listing as JSON. It pages and filters like the HTML listing,
+        and ?fields=a,b only selects those fields (and the id). '''
+        def _function():
+            def _render():
+                before = request.args.get("before", type=int)
+                after = request.args.get("after", type=int)
+                limit = request.args.get("limit", DEFAULT_PAGE_SIZE, type=int)
+                filter_args = [(key, value) for key, value in request.args.iteritems(multi=True) if key not in ("before", "after", "limit", "fields")]
+                try:
+                    filters = self.cruddy.storage.parse_filters(meta_object, filter_args)
+                    columns = self.cruddy.storage.get_accessor(meta_object).parse_fields(request.args.get("fields"))
+                except ValueError, e:
+                    abort(400, str(e))
+                return jsonify(self.cruddy.storage.get_json_page(meta_object, before, after, limit, filters, columns))
+            return self.conditional(meta_object, _render)
+        return _function
+
+
+    def generate_view_json_routing(self, meta_object):
+        ''' Generates a function that will return a single entry as JSON, ?fields=a,b only selecting those fields (and the id). '''
+        def _function(**kwargs):
+            def _render():
+                accessor = self.cruddy.storage.get_accessor(meta_object)
+                try:
+                    columns = accessor.parse_fields(request.args.get("fields"))
+                except ValueError, e:
+                    abort(400, str(e))
+                values = self.cruddy.storage.get_entry_values(meta_object, kwargs["id"], columns)
+                if values is None:
+                    abort(404)
+                return jsonify(accessor.json_entries(columns, [values])[0])
+            return self.conditional(meta_object, _render)
         return _function
 
 
+    def conditional(self, meta_object, render):
+        ''' Answers 304 Not Modified, without calling render(), if the client's copy is still current. The ETag comes from the
+        object's version, which every write bumps, and the full URL, so each page and projection gets its own. '''
+        etag = hashlib.sha1("%s %s" % (self.cruddy.storage.get_version(meta_object), request.full_path)).hexdigest()
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = render()
+        # Weak, since compression changes the bytes but not what they mean.
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+
     def generate_view_routing(self, meta_object):
         ''' Generates a function that will return the rendering for the specific object name '''
         def _function(**kwargs):
-            entry = self.cruddy.storage.get_entry(meta_object, kwargs["id"])
-            title = meta_object.name
-            return render_template(meta_object.name.lower() + "_view" + HTML_FILE_SUFFIX, title=title, entry=entry)
+            def _render():
+                entry = self.cruddy.storage.get_entry(meta_object, kwargs["id"])
+                if entry is None:
+                    abort(404)
+                title = meta_object.name
+                links = self.cruddy.storage.get_links(meta_object, [entry])
+                return self.render(meta_object.name.lower() + "_view" + HTML_FILE_SUFFIX, title=title, entry=entry, links=links)
+            return self.cached(meta_object, (meta_object.name.lower(), "view", kwargs["id"]), _render)
         return _function
 
 
+    def generate_search_routing(self, meta_object):
+        ''' Generates a function that will return ranked full-text search results for the specific object name. '''
+        def _function():
+            if not self.cruddy.storage.can_search(meta_object):
+                abort(404)
+            query = request.args.get("q", u"")
+            limit = request.args.get("limit", DEFAULT_PAGE_SIZE, type=int)
+            results = [(entry, self.highlight(snippet)) for entry, snippet in self.cruddy.storage.search(meta_object, query, limit)]
+            return self.render(meta_object.name.lower() + "_search" + HTML_FILE_SUFFIX, title="Search " + meta_object.name, query=query, results=results)
+        return _function
+
+
+    @staticmethod
+    def highlight(snippet):
+        ''' Escapes a search snippet and marks up the matched terms in it. '''
+        return Markup.escape(snippet).replace(SEARCH_MATCH_START, Markup("<mark>")).replace(SEARCH_MATCH_END, Markup("</mark>"))
+
+
     def generate_new_routing(self, meta_object):
         ''' Generates a function that will return the rendering for the new-object form for the specific object name. '''
         def _function():
-            return render_template(meta_object.name.lower() + "_new" + HTML_FILE_SUFFIX, title="New" + meta_object.name)
+            return self.render(meta_object.name.lower() + "_new" + HTML_FILE_SUFFIX, title="New" + meta_object.name)
         return _function
 
 
@@ -49,26 +181,223 @@ class Flaskrer:
         ''' Generates a function that will add a specified object to the database. '''
         def _function():
             fields = meta_object.fields
-            self.cruddy.storage.add_entry(meta_object, request.form, request.form['id'])
+            try:
+                self.cruddy.storage.add_entry(meta_object, request.form, request.form['id'])
+            except ValueError, e:
+                abort(400, str(e))
             return redirect('/%s/%s/' % (meta_object.name.lower(), request.form['id']))
         return _function
 
 
-    def build_routing(self, meta_object):
-        ''' Builds the URL routings from the objects we have. '''
-        lower_name = meta_object.name.lower()
-        self.app.add_url_rule('/%s/' % lower_name, "%s_list" % lower_name, self.generate_list_routing(meta_object)) # List
-        self.app.add_url_rule('/%s/<id>/' % lower_name, "%s_view" % lower_name, self.generate_view_routing(meta_object)) # View
-        self.app.add_url_rule('/%s/new/' % lower_name, "%s_new" % lower_name, self.generate_new_routing(meta_object)) # New
-        self.app.add_url_rule('/%s/add/' % lower_name, "%s_add" % lower_name, self.generate_add_routing(meta_object), methods=["POST"]) # Add
+    def generate_bulk_routing(self, meta_object):
+        ''' Generates a function that will stream a CSV or newline-delimited JSON body into the database in batches. '''
+        def _function():
+            if request.mimetype in ("text/csv", "application/csv"):
+                entries = csv.DictReader(request.stream)
+            else:
+                entries = self.read_ndjson(request.stream)
+            batch_size = request.args.get("batch_size", BULK_BATCH_SIZE, type=int)
+            report = self.cruddy.storage.add_entries(meta_object, entries, batch_size)
+            return jsonify(report), 200 if not report["rejected"] else 207
+        return _function
+
+
+    def generate_export_routing(self, meta_object):
+        ''' Generates a function that streams every entry of the object out as CSV or newline-delimited JSON, oldest first.
+
+        ?after=<id> carries on from after that id, for picking up an export that got cut off. Either format can be fed
+        straight back into the bulk route. '''
+        def _function(format):
+            after = request.args.get("after", None, type=int)
+            batch_size = max(1, min(request.args.get("batch_size", EXPORT_BATCH_SIZE, type=int), MAX_EXPORT_BATCH_SIZE))
+            accessor = self.cruddy.storage.get_accessor(meta_object)
+            entries = self.cruddy.storage.iter_entries(meta_object, after, batch_size)
+            if format == "csv":
+                response = Response(self.write_csv(accessor, entries, batch_size), mimetype="text/csv")
+            else:
+                response = Response(self.write_ndjson(accessor, entries, batch_size), mimetype="application/x-ndjson")
+            response.headers["Content-Disposition"] = 'attachment; filename="%s.%s"' % (meta_object.name.lower(), format)
+            return response
+        return _function
+
+
+    @staticmethod
+    def write_csv(accessor, entries, batch_size):
+        ''' Yields CSV for the entries, the header first and then a chunk per batch. Lists and messages are written as JSON. '''
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(accessor.field_names)
+        yield buffer.getvalue()
+        buffer.truncate(0)
+
+        count = 0
+        for entry in entries:
+            writer.writerow([Flaskrer.csv_value(value) for value in accessor.json_values(entry)])
+            count += 1
+            if count % batch_size == 0:
+                yield buffer.getvalue()
+                buffer.truncate(0)
+        yield buffer.getvalue()
+
+
+    @staticmethod
+    def csv_value(value):
+        if value is None:
+            return ""
+        if isinstance(value, (list, dict)):
+            return json.dumps(value)
+        if isinstance(value, unicode):
+            return value.encode("utf-8")
+        return value
+
+
+    @staticmethod
+    def write_ndjson(accessor, entries, batch_size):
+        ''' Yields newline-delimited JSON for the entries, a chunk per batch. '''
+        lines = []
+        for entry in entries:
+            lines.append(json.dumps(dict(zip(accessor.field_names, accessor.json_values(entry)))))
+            if len(lines) == batch_size:
+                yield "\n".join(lines) + "\n"
+                lines = []
+        if lines:
+            yield "\n".join(lines) + "\n"
+
+
+    @staticmethod
+    def read_ndjson(stream):
+        ''' Yields one dict per line of newline-delimited JSON, or the error for a line that doesn't parse. '''
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError, e:
+                yield ValueError("invalid JSON: %s" % e)
+
+
+    def build_routing(self):
+        ''' Builds the URL routings, one set for all the objects however many there are. '''
+        self.app.add_url_rule('/<object_name>/', "list", self.generate_dispatch("list")) # List
+        self.app.add_url_rule('/<object_name>/<id>/', "view", self.generate_dispatch("view")) # View
+        self.app.add_url_rule('/<object_name>/new/', "new", self.generate_dispatch("new")) # New
+        self.app.add_url_rule('/<object_name>/search/', "search", self.generate_dispatch("search")) # Search
+        self.app.add_url_rule('/<object_name>/add/', "add", self.generate_dispatch("add"), methods=["POST"]) # Add
+        self.app.add_url_rule('/<object_name>/bulk/', "bulk", self.generate_dispatch("bulk"), methods=["POST"]) # Bulk add
+        self.app.add_url_rule('/<object_name>/export.<any(csv, ndjson):format>', "export", self.generate_dispatch("export")) # Export
+        self.app.add_url_rule('/<object_name>.json', "list_json", self.generate_dispatch("list_json")) # JSON list
+        self.app.add_url_rule('/<object_name>/<id>.json', "view_json", self.generate_dispatch("view_json")) # JSON view
+
+
+    def generate_dispatch(self, action):
+        ''' Generates a function that finds the object a request is for, loading it if need be, and hands the request to
+        that object's route function for the action. '''
+        generate_routing = getattr(self, "generate_%s_routing" % action)
+        def _function(object_name, **kwargs):
+            meta_object = self.cruddy.meta_objects.get_object(object_name)
+            if meta_object is None:
+                abort(404)
+            route = self.routes.get((meta_object.name, action))
+            if route is None:
+                route = self.routes[(meta_object.name, action)] = generate_routing(meta_object)
+            return route(**kwargs)
+        return _function
+
+
+    def register_metrics(self):
+        ''' Times every request, logs the slow ones with their SQL, and serves everything we've measured at /_metrics. '''
+        metrics = self.cruddy.metrics
+        def before_request():
+            g.request_started = default_timer()
+            metrics.start_request()
+        def after_request(response):
+            seconds = default_timer() - g.request_started
+            route = request.endpoint or "unmatched"
+            # Only names of real objects, so made up URLs can't add series without end.
+            object_name = (request.view_args or {}).get("object_name", "").lower()
+            if object_name not in self.cruddy.meta_objects.objects_by_name:
+                object_name = ""
+            slow_queries = metrics.finish_request(route, object_name, request.method, response.status_code, seconds)
+            if slow_queries is not None:
+                self.app.logger.warning("Slow request: %s %s took %.3fs\n%s", request.method, request.full_path, seconds,
+                                        "\n".join("  %.3fs  %s" % (query_seconds, sql) for sql, query_seconds in slow_queries))
+            return response
+        self.app.before_request(before_request)
+        self.app.after_request(after_request)
+
+        def _metrics():
+            return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+        self.app.add_url_rule('/_metrics', "_metrics", _metrics)
+
+
+    def page_cache_metrics(self):
+        ''' The page cache's counters, as Prometheus exposition lines. '''
+        stats = self.page_cache.stats()
+        lines = []
+        for name, kind, help in [("hits", "counter", "Page cache hits."), ("misses", "counter", "Page cache misses."),
+                                 ("evictions", "counter", "Pages evicted to make room."), ("invalidations", "counter", "Pages dropped by writes."),
+                                 ("pages", "gauge", "Pages currently cached.")]:
+            metric = "cruddy_page_cache_%s%s" % (name, "_total" if kind == "counter" else "")
+            lines.extend(["# HELP %s %s" % (metric, help), "# TYPE %s %s" % (metric, kind), "%s %d" % (metric, stats[name])])
+        return lines
+
+
+    def register_static_files(self):
+        ''' Serves the static directory, picking the precompressed copy the browser prefers, and letting fingerprinted files be cached for good. '''
+        static_root = os.path.abspath(static_dir)
+        fingerprinted = set(self.cruddy.housekeeper.assets.values())
+        def _function(filename):
+            path = safe_join(static_root, filename)
+            if path is None or not os.path.isfile(path):
+                abort(404)
+            mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+            encoding = None
+            for candidate, suffix in (("br", ".br"), ("gzip", ".gz")):
+                if candidate in request.accept_encodings and os.path.isfile(path + suffix):
+                    path, encoding = path + suffix, candidate
+                    break
+
+            max_age = FINGERPRINTED_MAX_AGE if filename in fingerprinted else UNFINGERPRINTED_MAX_AGE
+            response = send_file(path, mimetype=mimetype, conditional=True, cache_timeout=max_age)
+            if encoding is not None:
+                response.headers["Content-Encoding"] = encoding
+            response.vary.add("Accept-Encoding")
+            response.headers["Cache-Control"] = "public, max-age=%d%s" % (max_age, ", immutable" if filename in fingerprinted else "")
+            return response
+        self.app.add_url_rule('/%s/<path:filename>' % static_dir, "static", _function)
+
+
+    def register_compression(self):
+        ''' Gzips HTML (and JSON and text) responses for browsers that take it. '''
+        def after_request(response):
+            if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+                    or "Content-Encoding" in response.headers or "gzip" not in request.accept_encodings
+                    or response.mimetype not in ("text/html", "application/json", "text/plain")):
+                return response
+            body = response.get_data()
+            if len(body) < MIN_COMPRESS_SIZE:
+                return response
+            buffer = StringIO()
+            compressed = gzip.GzipFile(filename="", mode="wb", compresslevel=6, fileobj=buffer, mtime=0)
+            compressed.write(body)
+            compressed.close()
+            response.set_data(buffer.getvalue())
+            response.headers["Content-Encoding"] = "gzip"
+            response.vary.add("Accept-Encoding")
+            return response
+        self.app.after_request(after_request)
 
 
     def register_db_connections(self):
-        ''' Registers the database opening with the start of a request, and closing with the end of a request. '''
+        ''' Registers the database opening with the start of a request, and closing with the end of a request.
+
+        Closing happens on teardown, which runs even when the view raised, so a failed write can't leave the pooled
+        connection holding the write lock. '''
         def before_request():
             self.cruddy.storage.open()
-        def after_request(response):
+        def teardown_request(exception):
             self.cruddy.storage.close()
-            return response
         self.app.before_request(before_request)
-        self.app.after_request(after_request)
\ No newline at end of file
+        self.app.teardown_request(teardown_request)
\ No newline at end of file
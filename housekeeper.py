@@ -1,16 +1,30 @@
+import gzip
+import hashlib
+import json
 import os
+import re
 import urllib
 from zipfile import ZipFile
-from utilities import source_dir, destination_dir, html_dir, static_dir, PROTO_FILE_SUFFIX, BOOTSTRAP_URL, ZIP_FILE_SUFFIX
+from utilities import source_dir, destination_dir, html_dir, static_dir, jinja_cache_dir, PROTO_FILE_SUFFIX, BOOTSTRAP_URL, ASSET_MANIFEST_FILE, COMPRESSIBLE_SUFFIXES, MIN_COMPRESS_SIZE
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Fingerprinted copies are named <name>.<first 12 hex digits of the content's sha1>.<suffix>.
+FINGERPRINTED_NAME = re.compile(r"\.[0-9a-f]{12}$")
 
 class Housekeeper:
 
-    def __init__(self, cruddy):
+    def __init__(self, cruddy, bootstrap_source=BOOTSTRAP_URL):
         ''' Make sure the folder structure is what we need and we have the files we need. '''
         self.cruddy = cruddy
+        self.bootstrap_source = bootstrap_source
 
         self.verify_structure()
         self.ensure_twitter_bootstrap()
+        self.assets = self.fingerprint_static_files()
 
 
     def verify_structure(self):
@@ -27,9 +41,10 @@ class Housekeeper:
             else:
                 raise Exception("Found no .proto files in source directory %s" % source_dir)
 
-        # Make sure the destination and HTML dirs exist.
+        # Make sure the destination, HTML and template cache dirs exist.
         self.ensure_dir(destination_dir, files)
         self.ensure_dir(html_dir, files)
+        self.ensure_dir(jinja_cache_dir, files)
 
 
     def ensure_dir(self, dirname, files):
@@ -39,19 +54,99 @@ class Housekeeper:
 
 
     def ensure_twitter_bootstrap(self):
-        ''' Downloads Twitter Bootstrap and extracts it so we can use it. This could be done better. '''
-        bootstrap_file = BOOTSTRAP_URL.split("/")[-1]
-
+        ''' Downloads Twitter Bootstrap (or takes it from a local zip) and extracts it so we can use it. This could be done better. '''
         files = os.listdir(".")
         if static_dir not in files:
-            if bootstrap_file not in files:
-                print "Downloading Twitter Bootstrap..."
-                urllib.urlretrieve(BOOTSTRAP_URL, bootstrap_file)
+            if os.path.isfile(self.bootstrap_source):
+                bootstrap_file = self.bootstrap_source
+            else:
+                bootstrap_file = self.bootstrap_source.split("/")[-1]
+                if bootstrap_file not in files:
+                    print "Downloading Twitter Bootstrap..."
+                    urllib.urlretrieve(self.bootstrap_source, bootstrap_file)
 
             with ZipFile(bootstrap_file, 'r') as myzip:
                 myzip.extractall()
+                # Everything in the zipfile sits in one top-level folder, whatever the zipfile itself is called.
+                bootstrap_folder = myzip.namelist()[0].split("/")[0]
 
-            # The folder name that the zipfile extracts to is the same as the zipfile name, sans suffix.
-            bootstrap_folder = bootstrap_file[0:-len(ZIP_FILE_SUFFIX)]
             os.rename(bootstrap_folder, static_dir)
-            print "Done!"
\ No newline at end of file
+            print "Done!"
+
+
+    def fingerprint_static_files(self):
+        ''' Gives every static file a copy with its content hash in the name, so it can be cached forever, plus gzip
+        (and brotli, if it's installed) copies to serve to browsers that take them. Returns the path -> fingerprinted
+        path manifest, which is also saved in the static directory. '''
+        manifest_file = os.path.join(static_dir, ASSET_MANIFEST_FILE)
+        try:
+            with open(manifest_file) as manifest:
+                old_assets = json.load(manifest)
+        except (IOError, ValueError):
+            old_assets = {}
+
+        assets = {}
+        for directory, _, filenames in os.walk(static_dir):
+            for filename in filenames:
+                path = os.path.relpath(os.path.join(directory, filename), static_dir).replace(os.sep, "/")
+                if path == ASSET_MANIFEST_FILE or path.endswith((".gz", ".br", ".tmp")) or self.is_fingerprinted(path):
+                    continue
+                assets[path] = self.fingerprint(path, old_assets.get(path))
+
+        if assets != old_assets:
+            with open(manifest_file + ".tmp", 'w') as manifest:
+                json.dump(assets, manifest, indent=2, sort_keys=True)
+            os.rename(manifest_file + ".tmp", manifest_file)
+        return assets
+
+
+    @staticmethod
+    def is_fingerprinted(path):
+        ''' Whether the path is one of our fingerprinted copies, going by its name. Copies made for an older version of
+        a file stay around for pages that still link them, and mustn't be fingerprinted again themselves. '''
+        return FINGERPRINTED_NAME.search(os.path.splitext(path)[0]) is not None
+
+
+    def fingerprint(self, path, old_fingerprinted_path=None):
+        ''' Writes the fingerprinted and compressed copies of one static file, if they aren't there already. The file's
+        own compressed copies are written again if it's changed since the last manifest was made. '''
+        with open(os.path.join(static_dir, path), 'rb') as static_file:
+            content = static_file.read()
+        root, suffix = os.path.splitext(path)
+        fingerprinted_path = "%s.%s%s" % (root, hashlib.sha1(content).hexdigest()[:12], suffix)
+
+        full_path = os.path.join(static_dir, fingerprinted_path)
+        if not os.path.exists(full_path):
+            self.write_file(full_path, content)
+
+        if suffix in COMPRESSIBLE_SUFFIXES and len(content) >= MIN_COMPRESS_SIZE:
+            # A fingerprinted copy's compressed copies can't go stale, but the ones next to the file itself can.
+            changed = fingerprinted_path != old_fingerprinted_path
+            for original in (os.path.join(static_dir, path), full_path):
+                stale = changed and original != full_path
+                if stale or not os.path.exists(original + ".gz"):
+                    with open(original + ".gz.tmp", 'wb') as raw_file:
+                        compressed = gzip.GzipFile(filename="", mode="wb", compresslevel=9, fileobj=raw_file, mtime=0)
+                        compressed.write(content)
+                        compressed.close()
+                    os.rename(original + ".gz.tmp", original + ".gz")
+                if brotli is not None and (stale or not os.path.exists(original + ".br")):
+                    self.write_file(original + ".br", brotli.compress(content))
+        else:
+            # Too small (or not worth it) to compress any more, so copies of an older version must not be served instead.
+            for compressed_suffix in (".gz", ".br"):
+                if os.path.exists(os.path.join(static_dir, path) + compressed_suffix):
+                    os.remove(os.path.join(static_dir, path) + compressed_suffix)
+        return fingerprinted_path
+
+
+    @staticmethod
+    def write_file(path, content):
+        with open(path + ".tmp", 'wb') as output_file:
+            output_file.write(content)
+        os.rename(path + ".tmp", path)
+
+
+    def asset_url(self, path):
+        ''' The URL to link a static file by: its fingerprinted copy if it has one. '''
+        return "/%s/%s" % (static_dir, self.assets.get(path, path))
@@ -1,29 +1,80 @@
 import os
-from utilities import html_dir, HTML_FILE_SUFFIX
+import tempfile
+from StringIO import StringIO
+from utilities import html_dir, HTML_FILE_SUFFIX, JQUERY_URL
+
+class TemplateFile(StringIO):
+
+    def __init__(self, path):
+        ''' A template being generated. It's only written to disk on close, and only if it came out different. '''
+        StringIO.__init__(self)
+        self.path = path
+
+
+    def close(self):
+        content = self.getvalue()
+        StringIO.close(self)
+        if os.path.exists(self.path):
+            with open(self.path) as existing:
+                if existing.read() == content:
+                    return
+
+        # Write next to it and rename over it, so Jinja never sees half a template. Each writer gets its own temporary
+        # file, since every worker generates the same pages at startup.
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(handle, 'w') as output_file:
+                output_file.write(content)
+            os.rename(temp_path, self.path)
+        except:
+            os.remove(temp_path)
+            raise
+
+
 class HTMLGenerator:
 
+    # The pages every object gets, named <object>_<page>.html.
+    object_pages = ("list", "view", "new", "search")
+
     def __init__(self, cruddy):
         self.cruddy = cruddy
-        self.clear_html_pages()
+        self.templates = set()
         self.generate_base_page()
-        for generated_object in cruddy.get_objects():
-            self.generate_list_page(generated_object)
-            self.generate_view_page(generated_object)
-            self.generate_new_page(generated_object)
+        self.clear_stale_html_pages()
+
+        # An object's own pages are generated when it loads.
+        cruddy.meta_objects.load_listeners.append(self.generate_pages)
+
 
+    def generate_pages(self, meta_object):
+        ''' Generates every page for the object. '''
+        self.generate_list_page(meta_object)
+        self.generate_view_page(meta_object)
+        self.generate_new_page(meta_object)
+        self.generate_search_page(meta_object)
 
-    def clear_html_pages(self):
-        ''' Clears the HTML page directory '''
+
+    def open_template(self, filename):
+        ''' Opens a template in the HTML page directory for generating. Unchanged templates keep their file and mtime. '''
+        self.templates.add(filename)
+        return TemplateFile(os.path.join(html_dir, filename))
+
+
+    def clear_stale_html_pages(self):
+        ''' Clears anything in the HTML page directory that isn't one of our pages, like those of objects that have gone away. '''
+        pages = set(self.templates)
+        for meta_object in self.cruddy.get_objects():
+            pages.update(meta_object.name.lower() + "_" + page + HTML_FILE_SUFFIX for page in self.object_pages)
         html_files = os.listdir(html_dir)
         for html_file in html_files:
             path = os.path.join(html_dir, html_file)
-            if os.path.isfile(path):
+            if html_file not in pages and os.path.isfile(path):
                 os.unlink(path)
 
 
     def generate_list_page(self, meta_object):
         ''' Generates an HTML page for a listing of all instances of the given meta_object. '''
-        output_file = open(os.path.join(html_dir, meta_object.name.lower() + "_list" + HTML_FILE_SUFFIX), 'w')
+        output_file = self.open_template(meta_object.name.lower() + "_list" + HTML_FILE_SUFFIX)
         output_file.write('''
             {% extends "base.html" %}
             {% block body %}
@@ -31,24 +82,35 @@ class HTMLGenerator:
             ''')
         output_file.write('''
               <h2><a href="/%s/{{ entry.id }}/">{{ entry.name }}</a></h2>''' % meta_object.name.lower())
+        for field in meta_object.fields:
+            if field.get("references"):
+                output_file.write(self.generate_link(field, "muted"))
         output_file.write('''
             {% else %}''')
         output_file.write('''
               <em>Nothing found! Maybe you should <a href="/%s/new/">add a new one</a>?</em>\n''' % meta_object.name.lower()) 
         output_file.write('''
-            {% endfor %}
-            {% endblock %}\n''')
+            {%% endfor %%}
+            <ul class="pager">
+              {%% if page.previous %%}<li class="previous"><a href="/%(name)s/?after={{ page.previous }}&limit={{ page.limit }}{{ page.filter_query }}">&larr; Newer</a></li>{%% endif %%}
+              {%% if page.next %%}<li class="next"><a href="/%(name)s/?before={{ page.next }}&limit={{ page.limit }}{{ page.filter_query }}">Older &rarr;</a></li>{%% endif %%}
+            </ul>
+            <p class="muted">{{ page.total }} total</p>
+            {%% endblock %%}\n''' % {"name": meta_object.name.lower()})
         output_file.close()
 
 
     def generate_view_page(self, meta_object):
         ''' Generates an HTML page for the object! '''
-        output_file = open(os.path.join(html_dir, meta_object.name.lower() + "_view" + HTML_FILE_SUFFIX), 'w')
+        output_file = self.open_template(meta_object.name.lower() + "_view" + HTML_FILE_SUFFIX)
         output_file.write('''
             {% extends "base.html" %}
             {% block body %}\n''')
         for field in meta_object.fields:
-            output_file.write('''<p>{{ entry.%s }} <span class="muted">%s</span></p>''' % (field["name"], field["type"]))
+            if field.get("references"):
+                output_file.write(self.generate_link(field))
+            else:
+                output_file.write('''<p>{{ entry.%s }} <span class="muted">%s</span></p>''' % (field["name"], field["type"]))
         
         output_file.write('''
             <p>Go back to the <a href="/%s/">list</p>
@@ -58,8 +120,16 @@ class HTMLGenerator:
         output_file.close()
 
 
+    def generate_link(self, field, css_class="link"):
+        ''' Generates a link to the entry a field points at, named from the linked entries the route loaded. '''
+        return '''
+              {%% set linked = links.%(column)s.get(entry.%(column)s) %%}
+              {%% if linked %%}<p class="%(css_class)s">%(name)s: <a href="/%(target)s/{{ linked.id }}/">{{ linked.name }}</a></p>{%% endif %%}''' % {
+                  "column": field["name"].lower(), "name": field["name"], "target": field["references"].lower(), "css_class": css_class}
+
+
     def generate_new_page(self, meta_object):
-        output_file = open(os.path.join(html_dir, meta_object.name.lower() + "_new" + HTML_FILE_SUFFIX), 'w')
+        output_file = self.open_template(meta_object.name.lower() + "_new" + HTML_FILE_SUFFIX)
 
         output_file.write('''
             {% extends "base.html" %}
@@ -80,18 +150,39 @@ class HTMLGenerator:
         output_file.close()
 
 
+    def generate_search_page(self, meta_object):
+        ''' Generates an HTML page for full-text search results over the object. '''
+        output_file = self.open_template(meta_object.name.lower() + "_search" + HTML_FILE_SUFFIX)
+        output_file.write('''
+            {%% extends "base.html" %%}
+            {%% block body %%}
+            <form action="/%(name)s/search/" method="GET">
+              <input type="text" name="q" value="{{ query }}"> <input type="submit" value="Search">
+            </form>
+            {%% for entry, snippet in results %%}
+              <h2><a href="/%(name)s/{{ entry.id }}/">{{ entry.name }}</a></h2>
+              <p>{{ snippet }}</p>
+            {%% else %%}
+              {%% if query %%}<em>Nothing matched "{{ query }}".</em>{%% endif %%}
+            {%% endfor %%}
+            <p>Go back to the <a href="/%(name)s/">list</p>
+            {%% endblock %%}\n''' % {"name": meta_object.name.lower()})
+        output_file.close()
+
+
     def generate_base_page(self):
-        output_file = open(os.path.join(html_dir, "base" + HTML_FILE_SUFFIX), 'w')
+        output_file = self.open_template("base" + HTML_FILE_SUFFIX)
         output_file.write(self.generate_base())
         output_file.close()
 
 
     def generate_base(self):
+        housekeeper = self.cruddy.housekeeper
         return '''
         <html>
             <head>
                 <title>{{ title }}</title>
-                <link href="/static/css/bootstrap.min.css" rel="stylesheet">
+                <link href="%(bootstrap_css)s" rel="stylesheet">
                 <style>
                   body {
                     padding-top: 60px; /* 60px to make the container go all the way to the bottom of the topbar */
@@ -121,11 +212,12 @@ class HTMLGenerator:
                 </div>
 
                 <div class="container">
-                {% block body %}{% endblock %}
+                {%% block body %%}{%% endblock %%}
                 </div>
 
-                <script src="http://code.jquery.com/jquery-latest.js"></script>
-                <script src="/static/js/bootstrap.min.js"></script>
+                <script src="%(jquery)s"></script>
+                <script src="%(bootstrap_js)s"></script>
             </body>
         </html>
-        '''
\ No newline at end of file
+        ''' % {"bootstrap_css": housekeeper.asset_url("css/bootstrap.min.css"), "jquery": JQUERY_URL,
+               "bootstrap_js": housekeeper.asset_url("js/bootstrap.min.js")}
\ No newline at end of file
@@ -0,0 +1,222 @@
+''' In-memory storage, for small hot lookup tables that shouldn't touch disk and for test runs that don't want a database
+file. Nothing survives a restart, and every process keeps its own copy. '''
+from __future__ import with_statement
+import operator
+import threading
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+from storage import Storage
+from utilities import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, BULK_BATCH_SIZE, MAX_BULK_BATCH_SIZE
+
+# What each filter operator from Accessor.parse_filters() means in Python.
+comparisons = {"=": operator.eq, ">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le}
+
+
+class MemoryTable:
+    ''' One object's entries: rows by primary key, every id in order for paging, and a dict per indexed column. '''
+
+    def __init__(self, accessor):
+        self.accessor = accessor
+        self.positions = dict((column, index) for index, column in enumerate(accessor.columns))
+        self.rows = {}
+        self.ids = []
+        # Secondary indexes, {column: {value: ids with that value, in order}}.
+        self.indexes = dict((column, {}) for column in accessor.indexed)
+        self.lock = threading.Lock()
+
+
+    def candidates(self, filters):
+        ''' The ids worth looking at for the filters: the shortest index entry an equality filter picks out, or every id. '''
+        best = self.ids
+        for column, op, value in filters:
+            if op != "=":
+                continue
+            if column == "id":
+                return [value] if value in self.rows else []
+            ids = self.indexes[column].get(value, [])
+            if len(ids) < len(best):
+                best = ids
+        return best
+
+
+    def matches(self, row, filters):
+        ''' Whether the row passes every filter. Like SQL, a missing value matches nothing. '''
+        for column, op, value in filters:
+            row_value = tuple.__getitem__(row, self.positions[column])
+            if row_value is None or not comparisons[op](row_value, value):
+                return False
+        return True
+
+
+    def select(self, before=None, after=None, limit=DEFAULT_PAGE_SIZE, filters=()):
+        ''' Gets up to limit matching rows, newest first, from past the before or after id if there is one. '''
+        with self.lock:
+            ids = self.candidates(filters)
+            if after is not None:
+                walk = xrange(bisect_right(ids, after), len(ids))
+            else:
+                walk = xrange((bisect_left(ids, before) if before is not None else len(ids)) - 1, -1, -1)
+
+            entries = []
+            for index in walk:
+                row = self.rows[ids[index]]
+                if self.matches(row, filters):
+                    entries.append(row)
+                    if len(entries) == limit:
+                        break
+
+        # Paging forward walks upwards from the cursor, so flip it back to newest first.
+        if after is not None:
+            entries.reverse()
+        return entries
+
+
+    def count(self, filters=()):
+        ''' Counts the matching rows, straight from the index when one equality filter is all there is. '''
+        with self.lock:
+            ids = self.candidates(filters)
+            if len(filters) == 1 and filters[0][1] == "=":
+                return len(ids)
+            return sum(1 for id in ids if self.matches(self.rows[id], filters))
+
+
+    def insert(self, batch):
+        ''' Adds a batch of rows, given as lists of column values, all or none of them.
+
+        Raises ValueError, adding nothing, if any row clashes with another on its id or a unique column. '''
+        id_index = self.accessor.id_index
+        with self.lock:
+            ids = set()
+            unique_values = set()
+            for values in batch:
+                id = values[id_index]
+                if id is None:
+                    raise ValueError("id is required")
+                if id in self.rows or id in ids:
+                    raise ValueError("duplicate id %s" % id)
+                ids.add(id)
+                for column in self.accessor.unique:
+                    value = values[self.positions[column]]
+                    if value is not None and (value in self.indexes[column] or (column, value) in unique_values):
+                        raise ValueError("duplicate %s %r" % (column, value))
+                    unique_values.add((column, value))
+
+            for values in batch:
+                row = self.accessor.make_row(values)
+                id = values[id_index]
+                self.rows[id] = row
+                insort(self.ids, id)
+                for column, index in self.indexes.iteritems():
+                    value = values[self.positions[column]]
+                    if value is not None:
+                        insort(index.setdefault(value, []), id)
+
+
+class MemoryStorage(Storage):
+
+    def __init__(self, cruddy, interactive=True, group_commit=False):
+        ''' Takes the same arguments as DBStorage so either can be configured, though there's no existing database to ask
+        about and no disk to group commits for. '''
+        Storage.__init__(self, cruddy)
+        self.tables = {}
+
+
+    def prepare(self, meta_object):
+        self.get_table(meta_object)
+
+
+    def get_table(self, meta_object):
+        ''' Gets the object's table, making an empty one the first time it's asked for. '''
+        table = self.tables.get(meta_object.name.lower())
+        if table is None:
+            table = self.tables[meta_object.name.lower()] = MemoryTable(self.get_accessor(meta_object))
+        return table
+
+
+    def get_entries(self, meta_object, before=None, after=None, limit=DEFAULT_PAGE_SIZE, filters=()):
+        ''' Gets a page of entries, newest first, seeking from the before or after id in the ordered id list. '''
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        return self.get_table(meta_object).select(before, after, limit, filters)
+
+
+    def get_entry(self, meta_object, id):
+        ''' Gets a single entry, the id being converted like any other id column value so "5" finds 5. '''
+        try:
+            id = self.get_accessor(meta_object).column_converters["id"](id)
+        except (TypeError, ValueError):
+            return None
+        return self.get_table(meta_object).rows.get(id)
+
+
+    def get_entries_by_id(self, meta_object, ids):
+        rows = self.get_table(meta_object).rows
+        return [rows[id] for id in ids if id in rows]
+
+
+    def has_entry_beyond(self, meta_object, id, older, filters=()):
+        if older:
+            return bool(self.get_table(meta_object).select(before=id, limit=1, filters=filters))
+        return bool(self.get_table(meta_object).select(after=id, limit=1, filters=filters))
+
+
+    def get_count(self, meta_object, filters=()):
+        return self.get_table(meta_object).count(filters)
+
+
+    def check_links(self, meta_object, batch):
+        ''' Checks every linking field in the batch points at an entry that exists, like SQLite's foreign keys do. '''
+        accessor = self.get_accessor(meta_object)
+        for column, target in accessor.references:
+            target_object = self.cruddy.meta_objects.get_object(target)
+            if target_object is None:
+                continue
+            rows = self.get_table(target_object).rows
+            position = accessor.columns.index(column)
+            for values in batch:
+                if values[position] is not None and values[position] not in rows:
+                    raise ValueError("no %s with id %s for %s" % (target, values[position], column))
+
+
+    def add_entry(self, meta_object, data, id):
+        ''' Puts a single entry into storage. Raises ValueError if it doesn't fit. '''
+        values = self.get_accessor(meta_object).coerce(data)
+        self.check_links(meta_object, [values])
+        self.get_table(meta_object).insert([values])
+        self.written(meta_object, [id])
+
+
+    def add_entries(self, meta_object, entries, batch_size=BULK_BATCH_SIZE):
+        ''' Puts a stream of entries into storage a batch at a time, reporting on each batch like DBStorage.add_entries(). '''
+        accessor = self.get_accessor(meta_object)
+        table = self.get_table(meta_object)
+        batch_size = max(1, min(batch_size, MAX_BULK_BATCH_SIZE))
+        report = {"inserted": 0, "rejected": 0, "batch_count": 0, "batches": []}
+
+        entries = iter(entries)
+        first_row = 1
+        while True:
+            batch = list(islice(entries, batch_size))
+            if not batch:
+                break
+
+            values, errors = [], []
+            for row_number, data in enumerate(batch, first_row):
+                try:
+                    values.append(accessor.coerce(data))
+                except ValueError, e:
+                    errors.append({"row": row_number, "error": str(e)})
+
+            inserted = 0
+            if values:
+                try:
+                    self.check_links(meta_object, values)
+                    table.insert(values)
+                    inserted = len(values)
+                    self.written(meta_object, [row[accessor.id_index] for row in values])
+                except ValueError, e:
+                    errors.append({"error": str(e)})
+
+            self.report_batch(report, first_row, len(batch), inserted, errors)
+            first_row += len(batch)
+
+        return report
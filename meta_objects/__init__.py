@@ -1,10 +1,13 @@
 import subprocess
 import sys
 import os
+import time
+import threading
 from google.protobuf.message import Message
 from google.protobuf.descriptor import FieldDescriptor
-from utilities import source_dir, destination_dir, html_dir, static_dir, HTML_FILE_SUFFIX, PROTO_FILE_SUFFIX, PYTHON_FILE_SUFFIX, PYTHON_GENERATED_SUFFIX, PROTO_TYPE_PREFIX
-from metaobject import MetaObject
+from utilities import source_dir, destination_dir, html_dir, static_dir, jinja_cache_dir, HTML_FILE_SUFFIX, PROTO_FILE_SUFFIX, PYTHON_FILE_SUFFIX, PYTHON_GENERATED_SUFFIX, PROTO_TYPE_PREFIX, OPTIONS_PROTO
+from metaobject import MetaObject, OPTIONS_PYTHON_FILE
+from protocache import ProtoCache
 
 class MetaObjects:
 
@@ -13,7 +16,13 @@ class MetaObjects:
 
         self.type_hash = self.build_type_hash()
         self.verify_structure()
+
+        # Called as listener(meta_object) when an object loads, before anything else gets to use it.
+        self.load_listeners = []
+        self.lock = threading.RLock()
+
         self.objects = self.generate_protos()
+        self.objects_by_name = dict((meta_object.name.lower(), meta_object) for meta_object in self.objects)
 
 
     def verify_structure(self):
@@ -30,9 +39,10 @@ class MetaObjects:
             else:
                 raise Exception("Found no .proto files in source directory %s" % source_dir)
 
-        # Make sure the destination and HTML dirs exist.
+        # Make sure the destination, HTML and template cache dirs exist.
         self.ensure_dir(destination_dir, files)
         self.ensure_dir(html_dir, files)
+        self.ensure_dir(jinja_cache_dir, files)
 
 
     def ensure_dir(self, dirname, files):
@@ -41,14 +51,37 @@ class MetaObjects:
             os.mkdir(dirname)
 
 
+    def get_object(self, name):
+        ''' Looks a MetaObject up by name, ignoring case, loading it if this is the first time it's been asked for.
+        Returns None if there's no such object. '''
+        meta_object = self.objects_by_name.get(name.lower())
+        if meta_object is not None:
+            meta_object.load()
+        return meta_object
+
+
     def generate_protos(self):
-        ''' Generates our MetaObjects (and the underlying Python objects) from the proto files. '''
-        generated = []
-        for proto in os.listdir(source_dir):
-            generated.append(MetaObject(self, proto))
+        ''' Generates our MetaObjects from the proto files. They're only registered here; each one imports its generated
+        module when it's first used, so start-up doesn't grow with the number of protos. '''
+        started = time.time()
+        protos = sorted(proto for proto in os.listdir(source_dir) if proto.endswith(PROTO_FILE_SUFFIX))
+        # Compiling still happens up front, in one protoc run, so workers never race each other to write the same module.
+        hits = ProtoCache().compile([OPTIONS_PROTO] + protos)
+        MetaObject.import_object(OPTIONS_PYTHON_FILE)
+        generated = [MetaObject(self, proto) for proto in protos]
+
+        self.report_startup(protos, hits, time.time() - started)
         return generated
 
 
+    def report_startup(self, protos, hits, total_time):
+        ''' Prints how long registering the protos took, and which ones protoc had to be run for. '''
+        misses = [proto for proto in protos if not hits[proto]]
+        print "Registered %d protos in %.3fs (%d cached, %d compiled)." % (len(protos), total_time, len(protos) - len(misses), len(misses))
+        for proto in misses:
+            print "  compiled %s" % proto
+
+
     ''' Creates a hash of the ProtocolBuffer types we have available, for lookup. '''
     def build_type_hash(self):
         type_hash = {}
@@ -1,23 +1,69 @@
+from __future__ import with_statement
 import subprocess
 import sys
-from utilities import source_dir, destination_dir, html_dir, static_dir, HTML_FILE_SUFFIX, PROTO_FILE_SUFFIX, PYTHON_FILE_SUFFIX, PYTHON_GENERATED_SUFFIX, PROTO_TYPE_PREFIX
+import os
+import time
+from utilities import source_dir, destination_dir, html_dir, static_dir, options_dir, HTML_FILE_SUFFIX, PROTO_FILE_SUFFIX, PYTHON_FILE_SUFFIX, PYTHON_GENERATED_SUFFIX, PROTO_TYPE_PREFIX, OPTIONS_PROTO
+
+OPTIONS_PYTHON_FILE = OPTIONS_PROTO[:-len(PROTO_FILE_SUFFIX)] + PYTHON_GENERATED_SUFFIX + PYTHON_FILE_SUFFIX
 
 class MetaObject:
 
     def __init__(self, meta_objects, proto):
         self.proto_file = proto
         self.meta_objects = meta_objects
-        self.name = proto[:len(PROTO_FILE_SUFFIX)]
+        self.name = proto[:-len(PROTO_FILE_SUFFIX)]
         self.python_file = self.name + PYTHON_GENERATED_SUFFIX + PYTHON_FILE_SUFFIX
         self.module = self.name + PYTHON_GENERATED_SUFFIX
 
-        self.generate_from_proto(self.proto_file)
-        self.import_object(self.python_file)
+        # Nothing's imported until load(), which happens the first time anything asks for the fields or the message.
+        self.loaded = False
+        self.loading = False
+
+
+    def __getattr__(self, name):
+        if name not in ("object", "fields"):
+            raise AttributeError(name)
+        self.load()
+        return self.__dict__[name]
+
+
+    def load(self):
+        ''' Imports the generated module and describes the fields, then lets the load listeners (storage, templates) set
+        the object up. Other threads wait until it's all done; a listener that needs the object again just gets it. '''
+        if self.loaded:
+            return
+        with self.meta_objects.lock:
+            if self.loaded or self.loading:
+                return
+            self.loading = True
+            try:
+                started = time.time()
+                # The generated module is already up to date by now, MetaObjects compiles everything in one go beforehand.
+                self.import_object(self.python_file)
+                self.object = getattr(sys.modules[self.module], self.name)()
 
-        self.object = getattr(sys.modules[self.python_file[:-len(PYTHON_FILE_SUFFIX)]], self.name)()
+                # The fields...field...is a list of dicts containing the field, its type and its Cruddy options.
+                self.fields = map(self.describe_field, self.get_proto_fields(self.object))
+                imported = time.time()
 
-        # The fields...field...is a list of dicts containing the field and its type.
-        self.fields = map(lambda field: {"name": field.name, "type": self.meta_objects.type_hash[field.type]}, self.get_proto_fields(self.object))
+                for listener in self.meta_objects.load_listeners:
+                    listener(self)
+                self.loaded = True
+                print "Loaded %s: import %.1fms, set up %.1fms" % (self.proto_file, (imported - started) * 1000, (time.time() - imported) * 1000)
+            finally:
+                self.loading = False
+
+
+    def describe_field(self, field):
+        ''' Builds the dict we keep for a proto field. '''
+        options = field.GetOptions().Extensions
+        options_module = sys.modules[OPTIONS_PYTHON_FILE[:-len(PYTHON_FILE_SUFFIX)]]
+        return {"name": field.name, "type": self.meta_objects.type_hash[field.type],
+                "indexed": options[options_module.indexed], "unique": options[options_module.unique],
+                "references": options[options_module.references] or None,
+                # Repeated and message fields don't fit a scalar column, so storage keeps them serialized.
+                "blob": field.label == field.LABEL_REPEATED or field.type in (field.TYPE_MESSAGE, field.TYPE_GROUP)}
 
 
     @staticmethod
@@ -27,9 +73,17 @@ class MetaObject:
 
 
     @staticmethod
-    def generate_from_proto(proto):
-        ''' Runs the Protocol Buffer generation command '''
-        subprocess.check_output(["protoc", "-I=%s" % source_dir, "--python_out=%s" % destination_dir, "%s/%s" % (source_dir, proto)]);
+    def generate_from_proto(*protos):
+        ''' Runs the Protocol Buffer generation command, once for however many protos it's given. '''
+        subprocess.check_output(["protoc", "-I=%s" % source_dir, "-I=%s" % options_dir, "--python_out=%s" % destination_dir] + map(MetaObject.source_path, protos));
+
+
+    @staticmethod
+    def source_path(proto):
+        ''' Where to find the given proto. Everything's in the source directory, apart from Cruddy's own options. '''
+        if proto == OPTIONS_PROTO:
+            return os.path.join(options_dir, proto)
+        return "%s/%s" % (source_dir, proto)
 
 
     @staticmethod
@@ -0,0 +1,67 @@
+import hashlib
+import json
+import os
+import subprocess
+from utilities import destination_dir, PROTO_FILE_SUFFIX, PYTHON_FILE_SUFFIX, PYTHON_GENERATED_SUFFIX, PROTO_CACHE_FILE
+from metaobject import MetaObject
+
+class ProtoCache:
+
+    def __init__(self):
+        ''' Remembers what each .proto looked like the last time protoc compiled it, so unchanged ones can skip protoc. '''
+        self.manifest_file = os.path.join(destination_dir, PROTO_CACHE_FILE)
+        self.protoc_version = self.get_protoc_version()
+        self.manifest = self.load_manifest()
+
+
+    @staticmethod
+    def get_protoc_version():
+        ''' Asks protoc which version it is, since a new protoc means everything has to be regenerated. '''
+        return subprocess.check_output(["protoc", "--version"]).strip()
+
+
+    def load_manifest(self):
+        ''' Loads the proto -> content hash manifest from the last run, if there's a usable one. '''
+        try:
+            with open(self.manifest_file) as manifest:
+                return json.load(manifest)
+        except (IOError, ValueError):
+            return {}
+
+
+    def save_manifest(self):
+        ''' Writes the manifest out atomically, so a crash mid-write can't leave a half-written one behind. '''
+        temp_file = self.manifest_file + ".tmp"
+        with open(temp_file, 'w') as manifest:
+            json.dump(self.manifest, manifest, indent=2, sort_keys=True)
+        os.rename(temp_file, self.manifest_file)
+
+
+    def hash_proto(self, proto):
+        ''' Hashes the proto's contents together with the protoc version. '''
+        digest = hashlib.sha1(self.protoc_version)
+        with open(MetaObject.source_path(proto), 'rb') as proto_file:
+            digest.update(proto_file.read())
+        return digest.hexdigest()
+
+
+    @staticmethod
+    def generated_file(proto):
+        ''' The path protoc writes the Python module for the given proto to. '''
+        return os.path.join(destination_dir, proto[:-len(PROTO_FILE_SUFFIX)] + PYTHON_GENERATED_SUFFIX + PYTHON_FILE_SUFFIX)
+
+
+    def compile(self, protos):
+        ''' Brings the generated modules up to date, running protoc once over every proto that changed.
+
+        Returns a dict of proto -> True if it was a cache hit, False if it had to be compiled. '''
+        hashes = dict((proto, self.hash_proto(proto)) for proto in protos)
+        hits = dict((proto, self.manifest.get(proto) == hashes[proto] and os.path.exists(self.generated_file(proto))) for proto in protos)
+
+        misses = [proto for proto in protos if not hits[proto]]
+        if misses:
+            MetaObject.generate_from_proto(*misses)
+            for proto in misses:
+                self.manifest[proto] = hashes[proto]
+            self.save_manifest()
+        return hits
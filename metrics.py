@@ -0,0 +1,131 @@
+import threading
+from bisect import bisect_left
+
+# Seconds, from a fast index lookup up to something that's gone badly wrong.
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROW_BUCKETS = (0, 1, 10, 25, 100, 500, 1000, 10000)
+
+
+def format_labels(label_names, label_values, extra=""):
+    pairs = ['%s="%s"' % (name, unicode(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+class Histogram:
+
+    def __init__(self, name, help, label_names=(), buckets=TIME_BUCKETS):
+        ''' A Prometheus-style histogram. Each observation is a bisect and a few additions under a lock. '''
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+
+    def observe(self, label_values, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            series = sorted((labels, list(counts), total, count) for labels, (counts, total, count) in self.series.items())
+        for label_values, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append("%s_bucket%s %d" % (self.name, format_labels(self.label_names, label_values, 'le="%s"' % bound), cumulative))
+            lines.append("%s_sum%s %r" % (self.name, format_labels(self.label_names, label_values), total))
+            lines.append("%s_count%s %d" % (self.name, format_labels(self.label_names, label_values), count))
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name, help, label_names=()):
+        ''' A Prometheus-style counter. '''
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+
+
+    def increment(self, label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            lines.append("%s%s %r" % (self.name, format_labels(self.label_names, label_values), value))
+        return lines
+
+
+class Metrics:
+
+    def __init__(self, slow_request_seconds=None):
+        ''' Request, query and template timings for the whole app, rendered in Prometheus' text format.
+
+        With slow_request_seconds set, the SQL each request runs is kept until it finishes, so slow ones can be logged. '''
+        self.slow_request_seconds = slow_request_seconds
+        self.local = threading.local()
+
+        self.requests = Histogram("cruddy_request_seconds", "Time spent handling requests.", ("route", "object", "method"))
+        self.responses = Counter("cruddy_responses_total", "Responses sent.", ("route", "object", "status"))
+        self.opens = Histogram("cruddy_storage_open_seconds", "Time spent opening storage for a request.")
+        self.queries = Histogram("cruddy_query_seconds", "Time spent running and fetching SQL queries.", ("query",))
+        self.query_rows = Histogram("cruddy_query_rows", "Rows returned or written by SQL queries.", ("query",), ROW_BUCKETS)
+        self.row_builds = Histogram("cruddy_row_build_seconds", "Time spent turning fetched results into row objects.", ("object",))
+        self.templates = Histogram("cruddy_template_render_seconds", "Time spent rendering templates.", ("template",))
+        self.families = [self.requests, self.responses, self.opens, self.queries, self.query_rows, self.row_builds, self.templates]
+
+        # Anything else that wants to show up at /_metrics, as functions returning lines of exposition text.
+        self.collectors = []
+
+
+    def start_request(self):
+        if self.slow_request_seconds is not None:
+            self.local.queries = []
+
+
+    def finish_request(self, route, object_name, method, status, seconds):
+        ''' Records a finished request, object_name being "" for routes that aren't about one. Returns the (sql, seconds)
+        it ran if it was slow, or None. '''
+        self.requests.observe((route, object_name, method), seconds)
+        self.responses.increment((route, object_name, status))
+        queries = getattr(self.local, "queries", None)
+        self.local.queries = None
+        if queries is not None and seconds >= self.slow_request_seconds:
+            return queries
+        return None
+
+
+    def record_query(self, name, sql, seconds, rows):
+        self.queries.observe((name,), seconds)
+        self.query_rows.observe((name,), rows)
+        queries = getattr(self.local, "queries", None)
+        if queries is not None:
+            queries.append((sql, seconds))
+
+
+    def render(self):
+        lines = []
+        for family in self.families:
+            lines.extend(family.render())
+        for collector in self.collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict, defaultdict
+
+class PageCache:
+
+    def __init__(self, max_pages):
+        ''' A size-bounded, least-recently-used cache of rendered pages, keyed by (object name, route, id or query).
+
+        Each page is kept with the version of its object it was rendered from, so a write made by another process makes
+        it stale as surely as one of ours. '''
+        self.max_pages = max_pages
+        self.pages = OrderedDict()
+        self.keys_by_object = defaultdict(set)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+
+    def get(self, key, version):
+        ''' Gets a cached page, or None if we don't have it for the object's current version. '''
+        with self.lock:
+            cached = self.pages.pop(key, None)
+            if cached is None or cached[0] != version:
+                if cached is not None:
+                    self.keys_by_object[key[0]].discard(key)
+                    self.invalidations += 1
+                self.misses += 1
+                return None
+            self.pages[key] = cached
+            self.hits += 1
+            return cached[1]
+
+
+    def put(self, key, page, version):
+        ''' Caches a page rendered from the given version of its object. Get the version before rendering, so a write
+        that lands while the page renders leaves it stale rather than mistaken for current. '''
+        with self.lock:
+            self.pages.pop(key, None)
+            self.pages[key] = (version, page)
+            self.keys_by_object[key[0]].add(key)
+            while len(self.pages) > self.max_pages:
+                old_key, _ = self.pages.popitem(last=False)
+                self.keys_by_object[old_key[0]].discard(old_key)
+                self.evictions += 1
+
+
+    def invalidate(self, object_name, ids=None):
+        ''' Drops the object's list pages, and its view pages for the given ids (or all of them if ids is None), straight
+        away rather than waiting for their versions to be checked. '''
+        if ids is not None:
+            ids = set(unicode(id) for id in ids)
+        with self.lock:
+            keys = self.keys_by_object[object_name]
+            for key in list(keys):
+                if key[1] != "view" or ids is None or unicode(key[2]) in ids:
+                    del self.pages[key]
+                    keys.discard(key)
+                    self.invalidations += 1
+
+
+    def stats(self):
+        ''' The counters, for sizing the cache. '''
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"pages": len(self.pages), "max_pages": self.max_pages, "hits": self.hits, "misses": self.misses,
+                    "hit_ratio": float(self.hits) / lookups if lookups else 0.0,
+                    "evictions": self.evictions, "invalidations": self.invalidations}
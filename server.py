@@ -0,0 +1,67 @@
+''' Production entry point: serves Cruddy from several processes, with debugging and the reloader off.
+
+    python server.py --workers 4 --threads 8 --port 8000
+
+or hand the app factory to any WSGI server, e.g.  gunicorn -w 4 --threads 8 "server:create_app()"
+'''
+import argparse
+import multiprocessing
+from cruddy import Cruddy, storage_backends
+from utilities import SERVER_HOST, SERVER_PORT, SERVER_THREADS, KEEPALIVE_SECONDS, GRACEFUL_TIMEOUT_SECONDS, PAGE_CACHE_SIZE, STORAGE_BACKEND
+
+
+def create_app(page_cache_size=PAGE_CACHE_SIZE, storage_backend=STORAGE_BACKEND):
+    ''' WSGI app factory. Runs the start-up steps without asking anything, so an existing database is kept. '''
+    cruddy = Cruddy(page_cache_size=page_cache_size, interactive=False, storage_backend=storage_backend)
+
+    # Start-up used the database from this thread. Let those connections go, so forked workers open their own.
+    cruddy.storage.shutdown()
+
+    app = cruddy.flaskrer.app
+    app.debug = False
+    app.cruddy = cruddy
+    return app
+
+
+def serve(host=SERVER_HOST, port=SERVER_PORT, workers=None, threads=SERVER_THREADS, page_cache_size=PAGE_CACHE_SIZE, storage_backend=STORAGE_BACKEND):
+    ''' Serves the app with gunicorn if it's installed, falling back to Werkzeug's threaded server if it isn't. '''
+    workers = workers or multiprocessing.cpu_count()
+    if storage_backend == "memory" and workers > 1:
+        print "Warning: each worker keeps its own in-memory storage. Entries added through one won't show up in the others."
+    app = create_app(page_cache_size, storage_backend)
+
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        from werkzeug.serving import run_simple
+        print "gunicorn isn't installed, serving from a single threaded process instead."
+        run_simple(host, port, app, threaded=True, use_reloader=False, use_debugger=False)
+        return
+
+    class CruddyApplication(BaseApplication):
+
+        def load_config(self):
+            self.cfg.set("bind", "%s:%d" % (host, port))
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("keepalive", KEEPALIVE_SECONDS)
+            self.cfg.set("graceful_timeout", GRACEFUL_TIMEOUT_SECONDS)
+            self.cfg.set("worker_exit", lambda server, worker: app.cruddy.storage.shutdown())
+
+        def load(self):
+            return app
+
+    CruddyApplication().run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve Cruddy in production.")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--threads", type=int, default=SERVER_THREADS, help="threads per worker")
+    parser.add_argument("--page-cache-size", type=int, default=PAGE_CACHE_SIZE, help="rendered pages to cache per worker (0 is off)")
+    parser.add_argument("--storage", choices=sorted(storage_backends), default=STORAGE_BACKEND, help="where entries are kept")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, args.threads, args.page_cache_size, args.storage)
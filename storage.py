@@ -1,134 +1,1100 @@
 from __future__ import with_statement
 import sqlite3
+import json
 import os
+import random
+import threading
+import weakref
+from timeit import default_timer
+from collections import namedtuple, OrderedDict
+from functools import partial
+from itertools import islice
 from contextlib import closing
 import traceback
+from google.protobuf import json_format
+from google.protobuf.message import Message, EncodeError, DecodeError
+from writequeue import GroupCommitWriter
+from utilities import GROUP_COMMIT_MAX_BATCH, GROUP_COMMIT_MAX_DELAY, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, BULK_BATCH_SIZE, MAX_BULK_BATCH_SIZE, MAX_BULK_ERRORS, MAX_BULK_REPORTED_BATCHES, SEARCH_MATCH_START, SEARCH_MATCH_END, SEARCH_SNIPPET_TOKENS, EXPORT_BATCH_SIZE, MAX_EXPORT_BATCH_SIZE, MAX_FILTERS, QUERY_CACHE_SIZE, COUNT_CACHE_SIZE
 
-class DBStorage:
+class ConnectionPool:
+    ''' Keeps one long-lived SQLite connection per worker thread, so requests never pay for connecting. '''
+
+    statement_cache_size = 512
+    pragmas = [
+        "pragma journal_mode = wal",
+        "pragma synchronous = normal",
+        "pragma temp_store = memory",
+        "pragma cache_size = -16000",
+        "pragma mmap_size = 268435456",
+        "pragma foreign_keys = on",
+    ]
+
+    def __init__(self, database):
+        self.database = database
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # (weak reference to the owning thread, connection) for every connection handed out.
+        self.connections = []
+
+
+    def get(self):
+        ''' Returns the calling thread's connection, making it the first time that thread asks. '''
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.connect()
+            self.local.connection = connection
+            with self.lock:
+                self.close_orphans()
+                self.connections.append((weakref.ref(threading.current_thread()), connection))
+        return connection
+
+
+    def close_orphans(self):
+        ''' Closes the connections of threads that have finished. Servers that start a thread per request would otherwise
+        leave a connection behind for every request. Called with the lock held. '''
+        alive = []
+        for thread, connection in self.connections:
+            owner = thread()
+            if owner is not None and owner.is_alive():
+                alive.append((thread, connection))
+            else:
+                connection.close()
+        self.connections = alive
+
+
+    def connect(self):
+        ''' Opens and tunes a new connection. Only the owning thread ever uses it, we just close it from elsewhere. '''
+        connection = sqlite3.connect(self.database, cached_statements=self.statement_cache_size, check_same_thread=False)
+        for pragma in self.pragmas:
+            connection.execute(pragma)
+        return connection
+
+
+    def release(self):
+        ''' Hands the calling thread's connection back, rolling back anything a request left uncommitted. '''
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.rollback()
+
+
+    def close_all(self):
+        ''' Closes every connection the pool has handed out. '''
+        with self.lock:
+            for thread, connection in self.connections:
+                connection.close()
+            self.connections = []
+        self.local = threading.local()
+
+
+def to_text(value):
+    if isinstance(value, str):
+        return value.decode("utf-8")
+    return unicode(value)
+
+
+def to_bool(value):
+    if isinstance(value, basestring):
+        lowered = value.strip().lower()
+        if lowered in ("1", "true", "yes", "on"):
+            return True
+        if lowered in ("0", "false", "no", "off", ""):
+            return False
+        raise ValueError("not a boolean: %r" % value)
+    return bool(value)
+
+
+# How to turn incoming values into something that fits each proto type's column.
+converters = {
+    "double": float, "float": float,
+    "int32": int, "int64": int, "uint32": int, "uint64": int, "sint32": int, "sint64": int,
+    "fixed32": int, "fixed64": int, "sfixed32": int, "sfixed64": int, "enum": int,
+    "bool": to_bool,
+    "string": to_text,
+}
+
+
+def encode_field(message_class, name, value):
+    ''' Serializes a repeated or message field on its own, as an otherwise empty message with just that field set.
+
+    Takes a message or anything ParseDict does (lists and dicts from JSON), or JSON text from forms and CSV. The container
+    is serialized partially, since its required fields (the id, at least) are never set. '''
+    if isinstance(value, basestring):
+        if not value.strip():
+            return None
+        value = json.loads(value)
+    if value is None:
+        return None
+    container = message_class()
+    try:
+        if isinstance(value, Message):
+            getattr(container, name).CopyFrom(value)
+        else:
+            json_format.ParseDict({name: value}, container)
+        return sqlite3.Binary(container.SerializePartialToString())
+    except (json_format.ParseError, EncodeError), e:
+        raise ValueError(str(e))
+
+
+def parse_container(message_class, data):
+    ''' Reads back a container encode_field() wrote, skipping the required field check it was written without. '''
+    container = message_class()
+    try:
+        container.MergeFromString(str(data))
+    except DecodeError, e:
+        raise ValueError(str(e))
+    return container
+
+
+def decode_field(message_class, name, data):
+    ''' The other half of encode_field(): gets the field's value back out of its column. '''
+    if data is None:
+        return None
+    return getattr(parse_container(message_class, data), name)
+
+
+def field_to_json(message_class, name, data):
+    ''' Gets a blob field's value as the lists and dicts json_format would write it as. '''
+    container = parse_container(message_class, data)
+    return json_format.MessageToDict(container, preserving_proto_field_name=True).get(name)
+
+
+def sqlite_has_fts5():
+    ''' Checks whether the SQLite we're linked against was built with full-text search. '''
+    try:
+        sqlite3.connect(":memory:").execute("create virtual table fts5_probe using fts5(text)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+HAS_FTS5 = sqlite_has_fts5()
+
+
+# Filter suffixes the list route understands, e.g. ?created_gt=... . A bare column name means equality.
+filter_operators = {"gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+
+
+def build_row_class(meta_object):
+    ''' Generates a slotted tuple type with the proto's field names, read either as entry.name or entry["name"]. '''
+    base = namedtuple(meta_object.name + "Row", [field["name"].lower() for field in meta_object.fields])
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    attributes = {"__slots__": (), "__getitem__": __getitem__}
+    # Blob fields hold their serialized bytes and are only decoded when something reads them by name.
+    for index, field in enumerate(meta_object.fields):
+        if field.get("blob"):
+            decode = partial(decode_field, type(meta_object.object), field["name"])
+            attributes[field["name"].lower()] = property(lambda self, index=index, decode=decode: decode(tuple.__getitem__(self, index)))
+    return type(base.__name__, (base,), attributes)
+
+
+class Accessor:
+    ''' Everything DBStorage needs to read and write one MetaObject, worked out once at startup instead of per request. '''
+
+    def __init__(self, meta_object):
+        self.table = meta_object.name.lower()
+        self.columns = [field["name"].lower() for field in meta_object.fields]
+        self.field_names = [field["name"] for field in meta_object.fields]
+        # Repeated and message fields are stored serialized, each in a blob column of its own.
+        self.blobs = [field for field in meta_object.fields if field.get("blob")]
+        encoders = dict((field["name"], partial(encode_field, type(meta_object.object), field["name"])) for field in self.blobs)
+        self.converters = [(field["name"], encoders.get(field["name"], converters.get(field["type"]))) for field in meta_object.fields]
+        self.id_index = self.columns.index("id")
+        self.column_list = ", ".join(self.columns)
+
+        # Columns with an index behind them. They're the only ones the list route will filter on, so a filter is never a table scan.
+        scalars = [field for field in meta_object.fields if not field.get("blob")]
+        self.indexed = [field["name"].lower() for field in scalars if field.get("indexed") or field.get("unique") or field.get("references")]
+        self.unique = set(field["name"].lower() for field in scalars if field.get("unique"))
+        # (column, object name) for every field that links to another object's id.
+        self.references = [(field["name"].lower(), field["references"]) for field in meta_object.fields if field.get("references")]
+        self.column_converters = dict((field["name"].lower(), converters.get(field["type"])) for field in meta_object.fields)
+
+        # Listing, counting and paging queries, built once per shape of filters and then reused.
+        self.queries = {}
+        self.list_sql = self.sql("list")
+        self.list_before_sql = self.sql("list", keyset="<")
+        self.list_after_sql = self.sql("list", keyset=">")
+        self.count_sql = self.sql("count")
+        self.older_sql = self.sql("exists", keyset="<")
+        self.newer_sql = self.sql("exists", keyset=">")
+
+        self.view_sql = 'select %s from %s where id = ?' % (self.column_list, self.table)
+
+        # String fields get a full-text index in a shadow FTS5 table, kept up to date by triggers.
+        self.text_columns = [field["name"].lower() for field in scalars if field["type"] == "string"]
+        self.search_table = self.table + "_search"
+        self.search_sql = None
+        if self.text_columns and HAS_FTS5:
+            self.search_sql = ('select %s, snippet(%s, -1, ?, ?, ?, ?) from %s join %s on %s.id = %s.rowid where %s match ? order by rank limit ?'
+                % (", ".join("%s.%s" % (self.table, column) for column in self.columns), self.search_table,
+                   self.search_table, self.table, self.table, self.search_table, self.search_table))
+        self.add_sql = 'insert into %s (%s) values (%s)' % (self.table, self.column_list, ", ".join("?" * len(self.columns)))
+
+        # Exports walk the whole table upwards from an id, so an interrupted one can carry on from the last id it got.
+        self.export_sql = 'select %s from %s order by id asc' % (self.column_list, self.table)
+        self.export_after_sql = 'select %s from %s where id > ? order by id asc' % (self.column_list, self.table)
+
+        # How to turn stored values back into JSON: booleans come back from SQLite as 0 and 1, and blobs need decoding.
+        self.json_converters = [(self.field_names.index(field["name"]), partial(field_to_json, type(meta_object.object), field["name"]))
+                                for field in self.blobs]
+        self.json_converters += [(index, bool) for index, field in enumerate(meta_object.fields) if field["type"] == "bool"]
+        self.column_json = dict((self.columns[index], converter) for index, converter in self.json_converters)
+
+        # Building rows straight off tuple.__new__ keeps the whole per-row path in C.
+        self.row_class = build_row_class(meta_object)
+        self.make_row = partial(tuple.__new__, self.row_class)
+
+
+    def view_sql_for(self, columns):
+        ''' Gets the query for a single entry that only selects the given columns. '''
+        return self.query(("view", columns), lambda: 'select %s from %s where id = ?' % (", ".join(columns), self.table))
+
+
+    def parse_fields(self, fields):
+        ''' Turns a comma separated ?fields= list into the columns to select, in field order and always with the id.
+        Returns None, meaning every column, if there's no list. Raises ValueError for fields the object doesn't have. '''
+        if not fields:
+            return None
+        requested = set(field.strip().lower() for field in fields.split(",") if field.strip())
+        unknown = requested.difference(self.columns)
+        if unknown:
+            raise ValueError("no such field: %s" % ", ".join(sorted(unknown)))
+        requested.add("id")
+        return tuple(column for column in self.columns if column in requested)
+
+
+    def by_ids_sql(self, count):
+        ''' Gets the query that fetches the entries with any of count ids, all at once. '''
+        return self.query(("ids", count), lambda: 'select %s from %s where id in (%s)' % (self.column_list, self.table, ", ".join("?" * count)))
+
+
+    def index_name(self, column):
+        ''' The name we give the index on a column. '''
+        return "%s_%s_index" % (self.table, column)
+
+
+    def parse_filters(self, args):
+        ''' Turns (key, value) request arguments into a list of (column, operator, value) filters.
+
+        Raises ValueError for anything that isn't an indexed column (or id), a value that doesn't fit its column, or more
+        than MAX_FILTERS filters. '''
+        args = list(args)
+        if len(args) > MAX_FILTERS:
+            raise ValueError("too many filters, at most %d can be used" % MAX_FILTERS)
+        filters = []
+        for key, value in args:
+            column, operator = key, "="
+            if key != "id" and key not in self.indexed:
+                column, _, suffix = key.rpartition("_")
+                operator = filter_operators.get(suffix)
+                if operator is None or (column != "id" and column not in self.indexed):
+                    raise ValueError("can't filter on %s, only indexed fields can be filtered on" % key)
+            converter = self.column_converters[column]
+            if converter is not None:
+                try:
+                    value = converter(value)
+                except (TypeError, ValueError), e:
+                    raise ValueError("bad value for %s: %s" % (key, e))
+            filters.append((column, operator, value))
+
+        # Sorted, so the same filters given in a different order share a query, and without repeats.
+        return sorted(set(filters))
+
+
+    def sql(self, kind, filters=(), keyset=None, columns=None):
+        ''' Gets the "list", "count" or "exists" query for the filters, with an id "<" or ">" keyset condition if asked.
+        A list only selects the given columns, if there are any. '''
+        shape = (kind, tuple((column, operator) for column, operator, _ in filters), keyset, columns)
+        return self.query(shape, lambda: self.build_sql(*shape))
+
+
+    def query(self, key, build):
+        ''' Gets the query cached under the key, building it with build() the first time. Once QUERY_CACHE_SIZE queries
+        are cached, new shapes are built every time instead of kept, so odd requests can't grow the cache forever. '''
+        sql = self.queries.get(key)
+        if sql is None:
+            sql = build()
+            if len(self.queries) < QUERY_CACHE_SIZE:
+                self.queries[key] = sql
+        return sql
+
+
+    def build_sql(self, kind, filter_shape, keyset, columns):
+        clauses = ["%s %s ?" % (column, operator) for column, operator in filter_shape]
+        if keyset is not None:
+            clauses.append("id %s ?" % keyset)
+        where = " where " + " and ".join(clauses) if clauses else ""
+
+        # Point SQLite at the index for the first equality filter, which hands rows back in id order just like the primary
+        # key does. A range index doesn't, so pages would have to sort every match; with only range filters SQLite is left
+        # to walk the primary key and stop once the page is full.
+        source = self.table
+        equality_filters = sorted(column for column, operator in filter_shape if column != "id" and operator == "=")
+        if equality_filters:
+            source += " indexed by " + self.index_name(equality_filters[0])
+
+        if kind == "list":
+            column_list = ", ".join(columns) if columns else self.column_list
+            return 'select %s from %s%s order by id %s limit ?' % (column_list, source, where, "asc" if keyset == ">" else "desc")
+        if kind == "count":
+            return 'select count(*) from %s%s' % (source, where)
+        return 'select 1 from %s%s limit 1' % (source, where)
+
+
+    def rows(self, results):
+        ''' Turns fetched results into row objects. '''
+        return map(self.make_row, results)
+
+
+    def row(self, result):
+        ''' Turns a single fetched result into a row object, passing None through. '''
+        return self.make_row(result) if result is not None else None
+
+
+    def json_values(self, row):
+        ''' The row's values in field order, as things json.dumps can write. '''
+        values = list(row)
+        for index, converter in self.json_converters:
+            if values[index] is not None:
+                values[index] = converter(values[index])
+        return values
+
+
+    def json_entries(self, columns, results):
+        ''' Turns results selecting just the given columns (None for all of them) into dicts json.dumps can write. '''
+        columns = columns or self.columns
+        names = [self.field_names[self.columns.index(column)] for column in columns]
+        converters = [(index, self.column_json[column]) for index, column in enumerate(columns) if column in self.column_json]
+        entries = []
+        for result in results:
+            values = list(result)
+            for index, converter in converters:
+                if values[index] is not None:
+                    values[index] = converter(values[index])
+            entries.append(dict(zip(names, values)))
+        return entries
+
+
+    def coerce(self, data):
+        ''' Pulls this object's column values out of a mapping, in insert order, checking every field is there and converting
+        it to its proto type. Raises ValueError if it can't.
+
+        A blank string is None for anything but a string field, since that's how forms send, and exports write, a field
+        that isn't set. '''
+        if isinstance(data, Exception):
+            raise data
+        if not isinstance(data, dict):
+            raise ValueError("expected an object, got %s" % type(data).__name__)
+        values = []
+        for name, converter in self.converters:
+            if name not in data:
+                raise ValueError("missing field %s" % name)
+            value = data[name]
+            if isinstance(value, basestring) and converter is not to_text and not value.strip():
+                value = None
+            if converter is not None and value is not None:
+                try:
+                    value = converter(value)
+                except (TypeError, ValueError), e:
+                    raise ValueError("bad value for %s: %s" % (name, e))
+            values.append(value)
+        return values
+
+
+class Storage:
+    ''' What every storage backend gives the rest of Cruddy. Backends fill in open/close, get_entries, get_entry,
+    add_entry and the few lookups paging is built from; listing pages, links and filters come for free. '''
+
+    def __init__(self, cruddy):
+        self.cruddy = cruddy
+        self.metrics = cruddy.metrics
+
+        # Called as listener(object_name, ids) after every write, ids being None if we can't say which rows changed.
+        self.write_listeners = []
+
+        self.accessors = {}
+        cruddy.meta_objects.load_listeners.append(self.prepare)
+
+        # Every object's version, bumped by each write to it. Versions start out random, so one from before a restart
+        # can't be mistaken for one after it.
+        self.versions = {}
+
+
+    def prepare(self, meta_object):
+        ''' Gets ready to store the object, the first time it's loaded. '''
+        self.get_accessor(meta_object)
+
+
+    def open(self):
+        ''' Opens the storage for use, once per request. '''
+        pass
+
+
+    def close(self):
+        ''' Closes the storage after use, once per request. '''
+        pass
+
+
+    def shutdown(self):
+        ''' Lets go of everything the storage is holding on to, for good. '''
+        pass
+
+
+    def get_accessor(self, meta_object):
+        ''' Gets the compiled accessor for the object, building it the first time it's asked for. '''
+        accessor = self.accessors.get(meta_object.name)
+        if accessor is None:
+            accessor = self.accessors[meta_object.name] = Accessor(meta_object)
+        return accessor
+
+
+    def parse_filters(self, meta_object, args):
+        ''' Turns request arguments into filters for get_entries/get_page. Raises ValueError if they can't be used. '''
+        return self.get_accessor(meta_object).parse_filters(args)
+
+
+    def get_entries(self, meta_object, before=None, after=None, limit=DEFAULT_PAGE_SIZE, filters=()):
+        ''' Gets a page of entries, newest first, starting past the before or after id if there is one. '''
+        raise NotImplementedError
+
+
+    def get_entry(self, meta_object, id):
+        ''' Gets a single entry, or None if there's no such entry. '''
+        raise NotImplementedError
+
+
+    def get_entries_by_id(self, meta_object, ids):
+        ''' Gets the entries with the given ids, in no particular order. '''
+        raise NotImplementedError
+
+
+    def get_values(self, meta_object, before=None, after=None, limit=DEFAULT_PAGE_SIZE, filters=(), columns=None):
+        ''' Like get_entries(), but gives back plain tuples of just the given columns' values (all of them for None).
+        This one picks them out of whole entries; backends that can select fewer columns do better. '''
+        entries = self.get_entries(meta_object, before, after, limit, filters)
+        return [self.pick_values(meta_object, entry, columns) for entry in entries]
+
+
+    def get_entry_values(self, meta_object, id, columns=None):
+        ''' Like get_entry(), but gives back a plain tuple of just the given columns' values, or None. '''
+        entry = self.get_entry(meta_object, id)
+        return self.pick_values(meta_object, entry, columns) if entry is not None else None
+
+
+    def pick_values(self, meta_object, entry, columns):
+        ''' The entry's raw values for the columns, or all of them for None. '''
+        if not columns:
+            return tuple(entry)
+        accessor = self.get_accessor(meta_object)
+        return tuple(tuple.__getitem__(entry, accessor.columns.index(column)) for column in columns)
+
+
+    def get_version(self, meta_object):
+        ''' Gets the object's version, which changes with every write to it. '''
+        return self.versions.setdefault(meta_object.name.lower(), random.getrandbits(48))
+
+
+    def bump_version(self, meta_object):
+        self.versions[meta_object.name.lower()] = self.get_version(meta_object) + 1
+
+
+    def has_entry_beyond(self, meta_object, id, older, filters=()):
+        ''' Checks whether there's anything matching past the given id. '''
+        raise NotImplementedError
+
+
+    def get_count(self, meta_object, filters=()):
+        ''' Gets the number of entries for the object matching the filters. '''
+        raise NotImplementedError
+
+
+    def add_entry(self, meta_object, data, id):
+        ''' Puts a single entry into storage. '''
+        raise NotImplementedError
+
+
+    def add_entries(self, meta_object, entries, batch_size=BULK_BATCH_SIZE):
+        ''' Puts a stream of entries into storage, batch by batch. Returns a report like DBStorage.add_entries(). '''
+        raise NotImplementedError
+
+
+    def iter_entries(self, meta_object, after=None, batch_size=EXPORT_BATCH_SIZE):
+        ''' Yields every entry, oldest first, starting past the after id if there is one. Only a batch is held at a time.
+
+        This one pages through get_entries(); backends that can hold a cursor open do better. '''
+        batch_size = max(1, min(batch_size, MAX_PAGE_SIZE))
+        while True:
+            entries = self.get_entries(meta_object, after=after, limit=batch_size)
+            if not entries:
+                return
+            entries.reverse()
+            for entry in entries:
+                yield entry
+            after = entries[-1].id
+
+
+    def can_search(self, meta_object):
+        ''' Whether search() can do anything for the object. '''
+        return False
+
+
+    def search(self, meta_object, query, limit=DEFAULT_PAGE_SIZE):
+        ''' Full-text searches the object, returning (entry, snippet) pairs. Backends without search find nothing. '''
+        return []
+
+
+    def get_page(self, meta_object, before=None, after=None, limit=DEFAULT_PAGE_SIZE, filters=()):
+        ''' Gets a page of entries along with the ids to link the next and previous pages from. '''
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        entries = self.get_entries(meta_object, before, after, limit, filters)
+        page = {"entries": entries, "limit": limit, "total": self.get_count(meta_object, filters), "links": self.get_links(meta_object, entries)}
+        self.add_cursors(meta_object, page, [entry.id for entry in entries], filters)
+        return page
+
+
+    def get_json_page(self, meta_object, before=None, after=None, limit=DEFAULT_PAGE_SIZE, filters=(), columns=None):
+        ''' Like get_page(), but the entries are dicts of just the given columns, ready for json.dumps. '''
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        accessor = self.get_accessor(meta_object)
+        values = self.get_values(meta_object, before, after, limit, filters, columns)
+        page = {"entries": accessor.json_entries(columns, values), "limit": limit, "total": self.get_count(meta_object, filters)}
+        id_position = (columns or accessor.columns).index("id")
+        self.add_cursors(meta_object, page, [value[id_position] for value in values], filters)
+        return page
+
+
+    def add_cursors(self, meta_object, page, ids, filters):
+        ''' Sets the page's "next" and "previous" ids from the ids on it, newest first, if there's anything older or newer. '''
+        page["next"] = page["previous"] = None
+        if ids:
+            if self.has_entry_beyond(meta_object, ids[-1], older=True, filters=filters):
+                page["next"] = ids[-1]
+            if self.has_entry_beyond(meta_object, ids[0], older=False, filters=filters):
+                page["previous"] = ids[0]
+
+
+    def get_links(self, meta_object, entries):
+        ''' Loads everything the entries link to, with one lookup per linking field however many entries there are.
+
+        Returns {column: {id: linked entry}}, for the templates to look the linked entries up in. '''
+        links = {}
+        for column, target in self.get_accessor(meta_object).references:
+            target_object = self.cruddy.meta_objects.get_object(target)
+            ids = set(getattr(entry, column) for entry in entries)
+            ids.discard(None)
+            links[column] = {}
+            if target_object is not None and ids:
+                links[column] = dict((entry.id, entry) for entry in self.get_entries_by_id(target_object, ids))
+        return links
+
+
+    def report_batch(self, report, first_row, rows, inserted, errors):
+        ''' Adds a finished bulk batch to the report. Only batches with errors are described, and only so many of them,
+        so the report stays the same size however big the upload is. '''
+        rejected = rows - inserted
+        report["inserted"] += inserted
+        report["rejected"] += rejected
+        report["batch_count"] += 1
+        if rejected and len(report["batches"]) < MAX_BULK_REPORTED_BATCHES:
+            report["batches"].append({"first_row": first_row, "rows": rows, "inserted": inserted,
+                                      "rejected": rejected, "errors": errors[:MAX_BULK_ERRORS]})
+
+
+    def written(self, meta_object, ids=None):
+        ''' Bumps the object's version and tells the write listeners. Call it after anything that writes to the object's entries. '''
+        self.bump_version(meta_object)
+        for listener in self.write_listeners:
+            listener(meta_object.name.lower(), ids)
+
+
+class DBStorage(Storage):
 
     SECRET_KEY = 'some key'
     USERNAME = 'admin'
     PASSWORD = 'default'
 
-    schema_file = "schema.sql"
     database = 'storage.db'
+    history_table = "schema_migrations"
+    version_table = "table_versions"
 
-    def __init__(self, cruddy):
-        self.cruddy = cruddy
-        self.db_connection = None
+    def __init__(self, cruddy, interactive=True, group_commit=False):
+        Storage.__init__(self, cruddy)
+        self.pool = ConnectionPool(self.database)
 
-        # If it exists, don't clobber it away!
+        # Row counts per table, as (version they were counted at, {filters: count}). Any worker's write changes the
+        # version, so a count is never served from before one. Only the COUNT_CACHE_SIZE most recently used are kept.
+        self.row_counts = {}
+        self.row_counts_lock = threading.Lock()
+
+        # If it exists, don't clobber it away! Unless asked to, an existing database is kept, and each object's tables
+        # are migrated forward (or created) when the object first loads.
         try:
-            destroy_response = ""
             if os.path.exists(self.database):
-                destroy_response = raw_input("Database exists! Should I DESTROY FOREVER, Y or N? [Y]: ")
-
-            if destroy_response.lower() is "y" or not destroy_response:
-                print "Destroying existing database. This cannot be undone."
-                self.generate_all_schema(cruddy.get_objects())
-                self.setup_db(self.schema_file)
+                destroy_response = raw_input("Database exists! Should I DESTROY FOREVER, Y or N? [N]: ") if interactive else ""
+                if destroy_response.lower() == "y":
+                    print "Destroying existing database. This cannot be undone."
+                    self.destroy()
         except KeyboardInterrupt:
             print "\nFigure your shit out."
             exit(1)
+        self.setup_db()
+
+        # With group commit on, add_entry hands its insert to a single writer thread instead of committing on its own.
+        self.group_commit = group_commit
+        self.writer = None
+        self.writer_lock = threading.Lock()
+
+
+    @property
+    def db_connection(self):
+        ''' The current thread's pooled connection. '''
+        return self.pool.get()
 
 
     def open(self):
         ''' Opens the storage for use. YOU are required to close it! Don't forget! '''
-        self.db_connection = sqlite3.connect(self.database)
+        started = default_timer()
+        self.pool.get()
+        self.metrics.opens.observe((), default_timer() - started)
 
 
     def close(self):
-        ''' Closes the opened storage system after use. '''
-        self.db_connection.close()
-        self.db_connection = None
+        ''' Closes the opened storage system after use. The connection itself stays pooled for the next request. '''
+        self.pool.release()
+
+
+    def get_writer(self):
+        ''' Gets the group commit writer, starting it on first use so every (possibly forked) process gets its own thread. '''
+        if self.writer is None:
+            with self.writer_lock:
+                if self.writer is None:
+                    self.writer = GroupCommitWriter(self.pool, GROUP_COMMIT_MAX_BATCH, GROUP_COMMIT_MAX_DELAY)
+        return self.writer
+
+
+    def shutdown(self):
+        ''' Finishes any queued writes, then closes every pooled connection for good. '''
+        with self.writer_lock:
+            if self.writer is not None:
+                self.writer.stop()
+                self.writer = None
+        self.pool.close_all()
 
 
-    def setup_db(self, schema_file):
-        ''' Returns a database connection object. '''
+    def setup_db(self):
+        ''' Makes sure the database exists with its migration history table. The objects' own tables come later, in prepare(). '''
         self.open()
-        self.load_schema(schema_file)
+        self.db_connection.executescript(self.generate_history_schema() + self.generate_version_schema())
         self.close()
 
 
-    def load_schema(self, schema_file):
-        f = open(schema_file)
-        self.db_connection.cursor().executescript(f.read())
+    def destroy(self):
+        ''' Deletes the database, along with SQLite's write-ahead log and its index. '''
+        self.pool.close_all()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.database + suffix):
+                os.remove(self.database + suffix)
+
+
+    def prepare(self, meta_object):
+        ''' Brings the object's tables up to date when it first loads, and warns about any filtered listing that would scan.
+
+        Objects it links to are loaded first, so their tables are there for the foreign keys to check against. '''
+        accessor = self.get_accessor(meta_object)
+        for column, target in accessor.references:
+            self.cruddy.meta_objects.get_object(target)
+        self.migrate([meta_object])
+        # Versions start out random, so one from before the database was destroyed can't be mistaken for a new one.
+        self.db_connection.execute("insert or ignore into %s (name, version) values (?, ?)" % self.version_table,
+                                   (meta_object.name.lower(), random.getrandbits(48)))
         self.db_connection.commit()
+        for sql, problem in self.check_query_plans([meta_object]):
+            print "Warning: filtered listing won't use an index (%s): %s" % (problem, sql)
+
+
+    def fetch(self, query_name, sql, params=(), one=False):
+        ''' Runs a query and fetches all of its results (or just the first, if one is set), recording how long that took. '''
+        started = default_timer()
+        cur = self.db_connection.execute(sql, params)
+        results = cur.fetchone() if one else cur.fetchall()
+        rows = (results is not None) if one else len(results)
+        self.metrics.record_query(query_name, sql, default_timer() - started, rows)
+        return results
+
+
+    def build_rows(self, meta_object, results):
+        ''' Turns fetched results into the object's row type, recording how long that took. '''
+        started = default_timer()
+        entries = self.get_accessor(meta_object).rows(results)
+        self.metrics.row_builds.observe((meta_object.name.lower(),), default_timer() - started)
+        return entries
+
 
+    def get_entries(self, meta_object, before=None, after=None, limit=DEFAULT_PAGE_SIZE, filters=()):
+        ''' Gets a page of entries from storage, newest first, seeking on the primary key rather than counting rows off. '''
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        sql, params = self.get_list_sql(meta_object, before, after, limit, filters)
+        entries = self.build_rows(meta_object, self.fetch(meta_object.name.lower() + ".list", sql, params))
 
-    def get_entries(self, meta_object):
-        ''' Gets a list of entries from storage. '''    
-        sql = self.get_list_sql(meta_object)
-        cur = self.db_connection.execute(sql)
-        entries = [self.dict_factory(cur, result) for result in cur.fetchall()]
+        # Paging forward seeks upwards from the cursor, so flip it back to newest first.
+        if after is not None:
+            entries.reverse()
         return entries
 
 
+    def get_values(self, meta_object, before=None, after=None, limit=DEFAULT_PAGE_SIZE, filters=(), columns=None):
+        ''' Like get_entries(), but only selects the given columns, handing their values back as they come. '''
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        sql, params = self.get_list_sql(meta_object, before, after, limit, filters, columns)
+        results = self.fetch(meta_object.name.lower() + ".list", sql, params)
+        if after is not None:
+            results.reverse()
+        return results
+
+
+    def get_entry_values(self, meta_object, id, columns=None):
+        accessor = self.get_accessor(meta_object)
+        sql = accessor.view_sql_for(columns) if columns else accessor.view_sql
+        return self.fetch(accessor.table + ".view", sql, (id,), one=True)
+
+
+    def get_version(self, meta_object):
+        ''' Gets the object's version from the versions table, so every worker sees every other worker's writes. '''
+        return self.fetch("versions", "select version from %s where name = ?" % self.version_table, (meta_object.name.lower(),), one=True)[0]
+
+
+    def bump_version(self, meta_object):
+        ''' Nothing to do: every write bumps the version itself, with version_bump(), in the same transaction. '''
+        pass
+
+
+    def version_bump(self, meta_object):
+        ''' The statement and parameters that bump the object's version. Writes run it once, just before they commit, so
+        nobody can see the new entries under the old version. '''
+        return "update %s set version = version + 1 where name = ?" % self.version_table, (meta_object.name.lower(),)
+
+
+    def has_entry_beyond(self, meta_object, id, older, filters=()):
+        ''' Checks whether there's anything matching past the given id, which is a single index lookup. '''
+        sql = self.get_accessor(meta_object).sql("exists", filters, "<" if older else ">")
+        return self.fetch(meta_object.name.lower() + ".exists", sql, [value for _, _, value in filters] + [id], one=True) is not None
+
+
+    def get_count(self, meta_object, filters=()):
+        ''' Gets the number of entries for the object matching the filters, only going to the database after a write. '''
+        name = meta_object.name.lower()
+        version = self.get_version(meta_object)
+        key = tuple(filters)
+        # Request threads share the cache, so it's only touched under the lock. The query itself runs outside it.
+        with self.row_counts_lock:
+            counted_at, counts = self.row_counts.get(name, (None, None))
+            if counted_at != version:
+                counts = OrderedDict()
+                self.row_counts[name] = (version, counts)
+            count = counts.pop(key, None)
+            if count is not None:
+                counts[key] = count
+                return count
+
+        sql = self.get_accessor(meta_object).sql("count", filters)
+        count = self.fetch(name + ".count", sql, [value for _, _, value in filters], one=True)[0]
+        with self.row_counts_lock:
+            # Another thread may have moved the cache on to a newer version while we counted; then ours isn't kept.
+            counted_at, counts = self.row_counts.get(name, (None, None))
+            if counted_at == version:
+                if key not in counts and len(counts) >= COUNT_CACHE_SIZE:
+                    counts.popitem(last=False)
+                counts[key] = count
+        return count
+
+
+
     def get_entry(self, meta_object, id):
         ''' Gets a single entry from storage. '''
-        sql = self.get_view_sql(meta_object)
-        cur = self.db_connection.execute(sql, id)
-        return self.dict_factory(cur, cur.fetchone())
+        accessor = self.get_accessor(meta_object)
+        return accessor.row(self.fetch(accessor.table + ".view", accessor.view_sql, (id,), one=True))
 
 
-    def dict_factory(self, cursor, row):
-        ''' Returns a dict of cursor results with the column names as keys. '''
-        d = {}
-        for idx, col in enumerate(cursor.description):
-            d[col[0]] = row[idx]
-        return d
+    def iter_entries(self, meta_object, after=None, batch_size=EXPORT_BATCH_SIZE):
+        ''' Yields every entry, oldest first, starting past the after id if there is one.
+
+        It's one query, read batch_size rows at a time with fetchmany, so memory stays flat however big the table is. The
+        query gets a connection of its own: it can outlive the request, and the request's connection is rolled back when
+        the request ends. '''
+        accessor = self.get_accessor(meta_object)
+        batch_size = max(1, min(batch_size, MAX_EXPORT_BATCH_SIZE))
+        sql, params = (accessor.export_sql, ()) if after is None else (accessor.export_after_sql, (after,))
+        started = default_timer()
+        rows = 0
+        connection = self.pool.connect()
+        try:
+            cursor = connection.execute(sql, params)
+            while True:
+                results = cursor.fetchmany(batch_size)
+                if not results:
+                    break
+                rows += len(results)
+                for entry in accessor.rows(results):
+                    yield entry
+        finally:
+            connection.close()
+            self.metrics.record_query(accessor.table + ".export", sql, default_timer() - started, rows)
+
+
+    def get_entries_by_id(self, meta_object, ids):
+        ''' Gets the entries with the given ids, in no particular order, a page's worth of ids per query. '''
+        accessor = self.get_accessor(meta_object)
+        ids = list(ids)
+        entries = []
+        for start in xrange(0, len(ids), MAX_PAGE_SIZE):
+            chunk = ids[start:start + MAX_PAGE_SIZE]
+            entries.extend(self.build_rows(meta_object, self.fetch(accessor.table + ".by_ids", accessor.by_ids_sql(len(chunk)), chunk)))
+        return entries
+
+
+    def can_search(self, meta_object):
+        return self.get_accessor(meta_object).search_sql is not None
+
+
+    def search(self, meta_object, query, limit=DEFAULT_PAGE_SIZE):
+        ''' Full-text searches the object's string fields, best match first.
+
+        Returns a list of (entry, snippet) pairs, the matched terms in each snippet sitting between SEARCH_MATCH_START
+        and SEARCH_MATCH_END. Every word in the query has to match; FTS5's own query syntax isn't exposed. '''
+        accessor = self.get_accessor(meta_object)
+        terms = query.split()
+        if accessor.search_sql is None or not terms:
+            return []
+        match = " ".join('"%s"' % term.replace('"', '""') for term in terms)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        results = self.fetch(accessor.table + ".search", accessor.search_sql, (SEARCH_MATCH_START, SEARCH_MATCH_END, u"\u2026", SEARCH_SNIPPET_TOKENS, match, limit))
+        return [(accessor.make_row(result[:-1]), result[-1]) for result in results]
 
 
     def add_entry(self, meta_object, data, id):
-        ''' Puts a single entry into storage. '''
-        sql = self.get_add_sql(meta_object)
-        data_for_object = map(lambda field: data[field["name"]], meta_object.fields)
-        self.db_connection.execute(sql, data_for_object)
-        self.db_connection.commit()
+        ''' Puts a single entry into storage. Raises ValueError if it doesn't fit. '''
+        accessor = self.get_accessor(meta_object)
+        values = accessor.coerce(data)
+        started = default_timer()
+        if self.group_commit:
+            self.get_writer().submit(accessor.add_sql, values, self.version_bump(meta_object))
+        else:
+            try:
+                self.db_connection.execute(accessor.add_sql, values)
+                self.db_connection.execute(*self.version_bump(meta_object))
+                self.db_connection.commit()
+            except sqlite3.Error:
+                self.db_connection.rollback()
+                raise
+        self.metrics.record_query(accessor.table + ".add", accessor.add_sql, default_timer() - started, 1)
+        self.written(meta_object, [id])
 
 
-    def generate_all_schema(self, meta_objects):
-        ''' Builds and outputs a schema file for the list of objects given. '''
-        output_file = open(self.schema_file, 'w')
-        for meta_object in self.cruddy.meta_objects.objects:
-            output_file.write(self.generate_schema(meta_object))
-        output_file.close
+    def add_entries(self, meta_object, entries, batch_size=BULK_BATCH_SIZE):
+        ''' Puts a stream of entries into storage, one transaction per batch, holding only one batch in memory at a time.
 
+        Entries are dicts keyed by field name; anything that couldn't be parsed upstream can be passed in as the
+        exception explaining why. Bad rows are left out of their batch, and a batch the database refuses is rolled
+        back whole. Returns a report with the totals and the errors from the first batches that had any. '''
+        accessor = self.get_accessor(meta_object)
+        connection = self.db_connection
+        batch_size = max(1, min(batch_size, MAX_BULK_BATCH_SIZE))
+        report = {"inserted": 0, "rejected": 0, "batch_count": 0, "batches": []}
 
-    def generate_schema(self, meta_object):
-        ''' Builds a SQL statement that defines a schema for a table that can hold the given object. '''
-        name = meta_object.name.lower()
+        entries = iter(entries)
+        first_row = 1
+        while True:
+            batch = list(islice(entries, batch_size))
+            if not batch:
+                break
+
+            values, errors = [], []
+            for row_number, data in enumerate(batch, first_row):
+                try:
+                    values.append(accessor.coerce(data))
+                except ValueError, e:
+                    errors.append({"row": row_number, "error": str(e)})
+
+            inserted = 0
+            if values:
+                try:
+                    started = default_timer()
+                    with connection:
+                        connection.executemany(accessor.add_sql, values)
+                        connection.execute(*self.version_bump(meta_object))
+                    inserted = len(values)
+                    self.metrics.record_query(accessor.table + ".add_batch", accessor.add_sql, default_timer() - started, inserted)
+                    self.written(meta_object, [row[accessor.id_index] for row in values])
+                except sqlite3.Error, e:
+                    errors.append({"error": str(e)})
+
+            self.report_batch(report, first_row, len(batch), inserted, errors)
+            first_row += len(batch)
+
+        return report
 
-        schema_sql = "drop table if exists %s;\ncreate table %s (\n" % (name, name)
+
+    def generate_table_schema(self, meta_object):
+        ''' Builds the create table statement for the object. '''
+        name = meta_object.name.lower()
         column_descriptors = []
         for field in meta_object.fields:
             column_name = field["name"]
-            column_type = field["type"].replace("int32", "integer")
-            if field["name"] is "id":
+            column_type = self.column_type(field)
+            if field["name"] == "id":
                 column_type += " primary key autoincrement"
             column_descriptors.append("  %s %s" % (column_name, column_type))
-        schema_sql += ",\n".join(column_descriptors)
-        schema_sql += "\n);"
+        return "create table %s (\n%s\n);\n" % (name, ",\n".join(column_descriptors))
 
-        return schema_sql
 
+    @staticmethod
+    def column_type(field):
+        if field.get("blob"):
+            return "blob"
+        column_type = field["type"].replace("int32", "integer")
+        if field.get("references"):
+            column_type += " references %s(id)" % field["references"].lower()
+        return column_type
 
-    def get_list_sql(self, meta_object):
-        name = meta_object.name.lower()
-        fields = meta_object.fields
 
-        return 'select %s from %s order by id desc' % (", ".join(map(lambda field: field["name"].lower(), fields)), name)
+    def generate_index_schema(self, accessor, column):
+        return "create %sindex if not exists %s on %s (%s);\n" % ("unique " if column in accessor.unique else "", accessor.index_name(column), accessor.table, column)
 
 
-    def get_add_sql(self, meta_object):
-        name = meta_object.name.lower()
-        fields = meta_object.fields
+    def generate_history_schema(self):
+        ''' Builds the table that records every migration we've applied. '''
+        return "create table if not exists %s (\n  id integer primary key autoincrement,\n  applied_at text,\n  statements text\n);\n" % self.history_table
 
-        return "insert into %s (%s) values (%s)" % (name, ", ".join(map(lambda field: field["name"].lower(), fields)), ", ".join(map(lambda field: "?", fields)))
 
+    def generate_version_schema(self):
+        ''' Builds the table holding each object's version, which every write to the object bumps. '''
+        return "create table if not exists %s (\n  name text primary key,\n  version integer not null\n);\n" % self.version_table
+
+
+    def get_live_columns(self, table):
+        ''' The column names the table has in the database right now, empty if it doesn't exist. '''
+        return [column[1].lower() for column in self.db_connection.execute("pragma table_info(%s)" % table).fetchall()]
+
+
+    def generate_migration(self, meta_object):
+        ''' Builds the statements that bring the object's tables in the live database up to date, without dropping any data.
+
+        Missing tables get created, and missing columns, indexes and search tables get added. Columns for fields that
+        have gone away are left where they are. '''
+        accessor = self.get_accessor(meta_object)
+        live_columns = self.get_live_columns(accessor.table)
+        if not live_columns:
+            statements = [self.generate_table_schema(meta_object)]
+        else:
+            statements = ["alter table %s add column %s %s;\n" % (accessor.table, field["name"], self.column_type(field))
+                          for field in meta_object.fields if field["name"].lower() not in live_columns]
+
+        live_indexes = [index[1] for index in self.db_connection.execute("pragma index_list(%s)" % accessor.table).fetchall()]
+        for column in accessor.indexed:
+            if accessor.index_name(column) not in live_indexes:
+                statements.append(self.generate_index_schema(accessor, column))
+
+        # Versions used to be bumped by a trigger on every inserted row. Writes bump them once per transaction now.
+        live_triggers = [trigger[0] for trigger in self.db_connection.execute(
+            "select name from sqlite_master where type = 'trigger' and tbl_name = ?", (accessor.table,)).fetchall()]
+        if accessor.table + "_version" in live_triggers:
+            statements.append("drop trigger if exists %s_version;\n" % accessor.table)
+
+        # The search table covers every string field, so a new one means building it again from the real table.
+        if accessor.search_sql and self.get_live_columns(accessor.search_table) != accessor.text_columns:
+            search = accessor.search_table
+            statements.append("drop table if exists %s;\n" % search)
+            statements.extend("drop trigger if exists %s_%s;\n" % (search, event) for event in ("insert", "delete", "update"))
+            statements.append(self.generate_search_schema(accessor))
+            statements.append("insert into %s (%s) values ('rebuild');\n" % (search, search))
+        return statements
 
-    def get_view_sql(self, meta_object):
-        name = meta_object.name.lower()
-        fields = meta_object.fields
 
-        return 'select %s from %s where id = ?' % (", ".join(map(lambda field: field["name"].lower(), fields)), name)
\ No newline at end of file
+    def migrate(self, meta_objects):
+        ''' Applies whatever the live database is missing for the objects, all in one transaction, and records it in the history table.
+
+        Another worker may be migrating the same object at the same time. If our statements no longer fit by the time we
+        get the write lock, we work them out again once. '''
+        connection = self.db_connection
+        for attempt in (1, 2):
+            statements = []
+            for meta_object in meta_objects:
+                statements.extend(self.generate_migration(meta_object))
+            if not statements:
+                return []
+
+            script = "".join(statements)
+            history = "insert into %s (applied_at, statements) values (datetime('now'), '%s');\n" % (self.history_table, script.replace("'", "''"))
+            try:
+                connection.executescript("begin immediate;\n" + script + history + "commit;\n")
+                break
+            except sqlite3.Error:
+                connection.executescript("rollback;")
+                if attempt == 2:
+                    raise
+        print "Migrated %s: %d change%s." % (self.database, len(statements), "" if len(statements) == 1 else "s")
+        return statements
+
+
+    def generate_search_schema(self, accessor):
+        ''' Builds the FTS5 table over the object's string fields, and the triggers that keep it in step with the real table. '''
+        columns = ", ".join(accessor.text_columns)
+        new_values = ", ".join("new." + column for column in accessor.text_columns)
+        old_values = ", ".join("old." + column for column in accessor.text_columns)
+        values = {"table": accessor.table, "search": accessor.search_table, "columns": columns, "new": new_values, "old": old_values}
+        return '''create virtual table %(search)s using fts5(%(columns)s, content='%(table)s', content_rowid='id');
+create trigger %(search)s_insert after insert on %(table)s begin
+  insert into %(search)s (rowid, %(columns)s) values (new.id, %(new)s);
+end;
+create trigger %(search)s_delete after delete on %(table)s begin
+  insert into %(search)s (%(search)s, rowid, %(columns)s) values ('delete', old.id, %(old)s);
+end;
+create trigger %(search)s_update after update on %(table)s begin
+  insert into %(search)s (%(search)s, rowid, %(columns)s) values ('delete', old.id, %(old)s);
+  insert into %(search)s (rowid, %(columns)s) values (new.id, %(new)s);
+end;
+''' % values
+
+
+    def get_list_sql(self, meta_object, before=None, after=None, limit=DEFAULT_PAGE_SIZE, filters=(), columns=None):
+        ''' Picks the keyset-paged listing query and its parameters. '''
+        accessor = self.get_accessor(meta_object)
+        params = [value for _, _, value in filters]
+        if after is not None:
+            return accessor.sql("list", filters, ">", columns), params + [after, limit]
+        if before is not None:
+            return accessor.sql("list", filters, "<", columns), params + [before, limit]
+        return accessor.sql("list", filters, None, columns), params + [limit]
+
+
+    def check_query_plans(self, meta_objects):
+        ''' Asks SQLite how it would run the objects' filtered listing queries, and returns (sql, problem) for any that would
+        sort every match to find a page, or scan the whole table for an equality filter its index should answer. '''
+        problems = []
+        for meta_object in meta_objects:
+            accessor = self.get_accessor(meta_object)
+            for column in accessor.indexed:
+                for operator in ("=", ">"):
+                    for keyset in (None, "<", ">"):
+                        sql = accessor.sql("list", [(column, operator, None)], keyset)
+                        try:
+                            plan = self.db_connection.execute("explain query plan " + sql, [None] * sql.count("?")).fetchall()
+                        except sqlite3.Error, e:
+                            problems.append((sql, str(e)))
+                            continue
+                        for step in plan:
+                            if "TEMP B-TREE" in step[-1] or (operator == "=" and step[-1].startswith("SCAN")):
+                                problems.append((sql, step[-1]))
+        return problems
+
+
+    def get_add_sql(self, meta_object):
+        return self.get_accessor(meta_object).add_sql
+
+
+    def get_view_sql(self, meta_object):
+        return self.get_accessor(meta_object).view_sql
\ No newline at end of file
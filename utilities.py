@@ -1,14 +1,76 @@
+import os
+
 source_dir = "protos"
 destination_dir = "objects"
 html_dir = "templates"
 static_dir = "static"
+jinja_cache_dir = "jinja_cache"
 
 HTML_FILE_SUFFIX = ".html"
 
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 500
+
+# Filters one list request may use, and how many differently shaped queries and filtered counts each object keeps around.
+MAX_FILTERS = 8
+QUERY_CACHE_SIZE = 256
+COUNT_CACHE_SIZE = 64
+
+# Rendered pages to keep in memory. 0 turns the page cache off.
+PAGE_CACHE_SIZE = 0
+
+# Requests slower than this get logged along with the SQL they ran. None turns the slow-request log off.
+SLOW_REQUEST_SECONDS = None
+
+# Where entries live: "sqlite" (storage.db) or "memory", which keeps everything in the process and loses it on restart.
+STORAGE_BACKEND = "sqlite"
+
+# Group commit: inserts from concurrent requests are queued to one writer thread and committed together.
+GROUP_COMMIT = False
+GROUP_COMMIT_MAX_BATCH = 256
+GROUP_COMMIT_MAX_DELAY = 0.0005
+
+# Production server defaults. Workers default to one per core.
+SERVER_HOST = "0.0.0.0"
+SERVER_PORT = 8000
+SERVER_THREADS = 4
+KEEPALIVE_SECONDS = 5
+GRACEFUL_TIMEOUT_SECONDS = 30
+
+BULK_BATCH_SIZE = 1000
+MAX_BULK_BATCH_SIZE = 10000
+MAX_BULK_ERRORS = 50
+# Bulk reports only describe batches that had errors, and only this many of them.
+MAX_BULK_REPORTED_BATCHES = 20
+
+# Exports fetch, and send on, this many rows at a time.
+EXPORT_BATCH_SIZE = 500
+MAX_EXPORT_BATCH_SIZE = 10000
+
+# Search snippets come back with the matched terms between these, for the templates to highlight.
+SEARCH_MATCH_START = u"\x02"
+SEARCH_MATCH_END = u"\x03"
+SEARCH_SNIPPET_TOKENS = 12
+
 PROTO_FILE_SUFFIX = ".proto"
 PYTHON_FILE_SUFFIX = ".py"
 ZIP_FILE_SUFFIX = ".zip"
 PYTHON_GENERATED_SUFFIX = "_pb2"
 PROTO_TYPE_PREFIX = "TYPE_"
+PROTO_CACHE_FILE = "protoc_cache.json"
+
+# Cruddy's own custom field options, which live with the code rather than in the working directory.
+options_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "options")
+OPTIONS_PROTO = "cruddy_options.proto"
+
+# Where to get Bootstrap from. A path to a local copy of the zip works too.
+BOOTSTRAP_URL = "http://twitter.github.com/bootstrap/assets/bootstrap.zip"
+# A pinned version, so browsers can cache it for good.
+JQUERY_URL = "//code.jquery.com/jquery-1.9.1.min.js"
 
-BOOTSTRAP_URL = "http://twitter.github.com/bootstrap/assets/bootstrap.zip"
\ No newline at end of file
+# Static files get a content hash in their names, listed in this manifest, plus precompressed copies.
+ASSET_MANIFEST_FILE = "assets.json"
+COMPRESSIBLE_SUFFIXES = (".css", ".js", ".html", ".svg", ".txt", ".json")
+MIN_COMPRESS_SIZE = 512
+FINGERPRINTED_MAX_AGE = 365 * 24 * 60 * 60
+UNFINGERPRINTED_MAX_AGE = 60 * 60
\ No newline at end of file
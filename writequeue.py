@@ -0,0 +1,103 @@
+import Queue
+import threading
+from timeit import default_timer
+
+STOP = object()
+
+
+class PendingWrite:
+
+    def __init__(self, sql, values, bump):
+        ''' One insert waiting for its group to be committed, with the (sql, params) that bumps its table's version. '''
+        self.sql = sql
+        self.values = values
+        self.bump = bump
+        self.done = threading.Event()
+        self.error = None
+
+
+class GroupCommitWriter:
+
+    def __init__(self, pool, max_batch, max_delay):
+        ''' A single writer thread that drains queued inserts and commits them in groups, so many writes share one fsync.
+
+        A group closes once it has max_batch writes, or max_delay seconds after its first write arrived. '''
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = Queue.Queue()
+        self.groups = 0
+        self.thread = threading.Thread(target=self.run, name="cruddy-group-commit")
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def submit(self, sql, values, bump):
+        ''' Queues an insert and waits until the group it went out in is durable. Raises whatever the insert raised.
+
+        bump is the (sql, params) statement that bumps the version of the insert's table. It's run once per table per
+        group, inside the group's transaction. '''
+        pending = PendingWrite(sql, values, bump)
+        self.queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+
+
+    def stop(self):
+        ''' Commits whatever's still queued, then stops the writer thread. '''
+        self.queue.put(STOP)
+        self.thread.join()
+
+
+    def run(self):
+        # The writer gets its own pooled connection. It manages its own transactions, and doesn't trade durability for speed.
+        connection = self.pool.get()
+        connection.isolation_level = None
+        connection.execute("pragma synchronous = full")
+
+        stopping = False
+        while not stopping:
+            first = self.queue.get()
+            if first is STOP:
+                break
+            group = [first]
+            deadline = default_timer() + self.max_delay
+            while len(group) < self.max_batch:
+                try:
+                    pending = self.queue.get(timeout=max(0, deadline - default_timer()))
+                except Queue.Empty:
+                    break
+                if pending is STOP:
+                    stopping = True
+                    break
+                group.append(pending)
+            self.commit(connection, group)
+
+
+    def commit(self, connection, group):
+        ''' Writes a group in one transaction. A savepoint per write means one bad insert doesn't take the others with it. '''
+        try:
+            connection.execute("begin immediate")
+            for pending in group:
+                connection.execute("savepoint pending_write")
+                try:
+                    connection.execute(pending.sql, pending.values)
+                except Exception, e:
+                    connection.execute("rollback to pending_write")
+                    pending.error = e
+                connection.execute("release pending_write")
+            for bump in set(pending.bump for pending in group if pending.error is None):
+                connection.execute(*bump)
+            connection.execute("commit")
+        except Exception, e:
+            # The commit itself failed, so none of the group made it. Rolling back can fail too if SQLite already did.
+            try:
+                connection.execute("rollback")
+            except Exception:
+                pass
+            for pending in group:
+                pending.error = pending.error or e
+        self.groups += 1
+        for pending in group:
+            pending.done.set()